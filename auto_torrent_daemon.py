@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# Resident mode: calendar refreshes, searches and adds run as recurring jobs in one process, so the
+# calendar, HTTP session, search cache and deluge connection stay warm between runs.
+import os
+import argparse
+import logging
+
+from deluge.ui.client import client
+from twisted.internet import reactor, defer, task, threads
+
+import deluge_torrent_adder
+import torrent_list_generator
+from http_client import get_http_client
+from indexers import INDEXERS_FILE_NAME, load_indexers
+from metrics import METRICS, profiled
+from pipeline import stream_releases
+from search_cache import SearchCache
+from state_store import open_state_store
+
+LOGGER = logging.getLogger(__name__)
+
+__location__ = os.path.realpath(os.path.join(
+    os.getcwd(), os.path.dirname(__file__)))
+
+CALENDAR_INTERVAL = 6 * 60 * 60
+SEARCH_INTERVAL = 30 * 60
+ADD_INTERVAL = 10 * 60
+
+
+class AutoTorrentDaemon:
+
+    def __init__(self, location: str = __location__, calendar_interval: float = CALENDAR_INTERVAL,
+                 search_interval: float = SEARCH_INTERVAL, add_interval: float = ADD_INTERVAL):
+        self._store = open_state_store(location)
+        self._http_client = get_http_client()
+        self._search_cache = SearchCache(torrent_list_generator.search_cache_file_name)
+        self._rarbg = torrent_list_generator.Rarbg(retries=10, workers=4, cache=self._search_cache,
+                                                   indexers=load_indexers(os.path.join(location, INDEXERS_FILE_NAME)))
+        self._calendar = None
+        # ep_name -> torrent options waiting to be sent to deluge by add()
+        self._add_queue = {}
+        self._adding = set()
+        # Deferreds of the jobs currently running, shutdown waits for them before closing the store
+        self._running = set()
+        # (job, interval, run as soon as the jobs start)
+        self._jobs = [(task.LoopingCall(self.refresh_calendar), calendar_interval, False),
+                      (task.LoopingCall(self.search), search_interval, True),
+                      (task.LoopingCall(self.add_pending), add_interval, True)]
+
+    def start(self):
+        LOGGER.info('Starting Auto Torrent daemon')
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        # The calendar is loaded once before anything else, the jobs then take over
+        return self.refresh_calendar().addCallback(lambda ignore: self._start_jobs())
+
+    def _start_jobs(self):
+        for job, interval, now in self._jobs:
+            # LoopingCall waits for the returned Deferred, so a slow run never overlaps the next one
+            job.start(interval, now=now).addErrback(self._log_failure, 'Job stopped')
+
+    def stop(self):
+        LOGGER.info('Stopping Auto Torrent daemon')
+        for job, interval, now in self._jobs:
+            if job.running:
+                job.stop()
+        d = defer.DeferredList(list(self._running))
+        d.addCallback(lambda ignore: client.disconnect() if client.connected() else None)
+        d.addBoth(lambda ignore: self._close())
+        return d
+
+    def _close(self):
+        self._rarbg.close()
+        self._search_cache.save()
+        self._http_client.log_stats()
+        self._store.close()
+
+    def _track(self, d):
+        self._running.add(d)
+
+        def untrack(result):
+            self._running.discard(d)
+            return result
+        return d.addBoth(untrack)
+
+    @staticmethod
+    def _log_failure(failure, message: str):
+        LOGGER.error('{}: {}'.format(message, failure.getTraceback()))
+
+    def refresh_calendar(self):
+        d = threads.deferToThread(torrent_list_generator.get_pog_calendar, self._http_client)
+        d.addCallback(self._set_calendar)
+        d.addErrback(self._log_failure, 'Calendar refresh failed')
+        return self._track(d)
+
+    def _set_calendar(self, calendar):
+        self._calendar = calendar
+
+    def search(self):
+        if self._calendar is None:
+            LOGGER.info('No calendar yet, skipping search')
+            return defer.succeed(None)
+        d = threads.deferToThread(self._search_releases)
+        d.addErrback(self._log_failure, 'Search failed')
+        return self._track(d)
+
+    def _search_releases(self):
+        # Runs in the reactor thread pool. Each episode goes to deluge as soon as its own search is done.
+        stream_releases(self._rarbg, self._store, self._calendar.get_today_releases(), add=self._add_from_thread,
+                        ranker=deluge_torrent_adder.RANKER, add_workers=deluge_torrent_adder.MAX_IN_FLIGHT)
+        torrent_list_generator.prefetch_releases(self._rarbg, self._calendar)
+        torrent_list_generator.warm_up_releases(self._rarbg, self._calendar)
+        self._search_cache.save()
+        # Counters keep growing for the life of the daemon, like any long running exporter
+        METRICS.write('daemon')
+
+    def _add_from_thread(self, torrent: dict):
+        # Called by the pipeline's add workers, blocks until deluge has answered
+        threads.blockingCallFromThread(reactor, self._add_one, torrent)
+
+    def _add_one(self, torrent: dict):
+        ep_name = torrent['ep_name']
+        if ep_name in self._adding:
+            return None
+        self._adding.add(ep_name)
+        d = self._connect()
+        d.addCallback(lambda ignore: deluge_torrent_adder.get_known_hashes())
+        d.addCallback(lambda known_hashes: deluge_torrent_adder.add_torrents([torrent], self._store,
+                                                                             known_hashes=known_hashes))
+        d.addErrback(self._log_failure, 'Adding {} failed'.format(torrent['title']))
+        d.addBoth(lambda ignore: self._adding.discard(ep_name))
+        return d
+
+    def add_pending(self):
+        # Picks up anything a failed add, an earlier crash or the cron generator left behind
+        d = threads.deferToThread(self._store.get_pending_torrents)
+        d.addCallback(self._add_queue.update)
+        d.addCallback(lambda ignore: self.add())
+        d.addErrback(self._log_failure, 'Adding pending torrents failed')
+        return self._track(d)
+
+    def add(self):
+        # Episodes whose add is still in flight are left out, they may have been queued again by add_pending
+        torrents = {ep_name: options for ep_name, options in self._add_queue.items() if ep_name not in self._adding}
+        self._add_queue = {}
+        if not torrents:
+            return defer.succeed(None)
+        self._adding.update(torrents)
+        d = self._connect()
+        d.addCallback(lambda ignore: deluge_torrent_adder.get_known_hashes())
+        d.addCallback(lambda known_hashes: threads.deferToThread(deluge_torrent_adder.select_torrents, torrents)
+                      .addCallback(deluge_torrent_adder.add_torrents, self._store, known_hashes=known_hashes))
+        d.addTimeout(deluge_torrent_adder.ADD_TIMEOUT, reactor, onTimeoutCancel=deluge_torrent_adder.on_timeout)
+        # Failed adds stay pending in the store and are retried by add_pending
+        d.addErrback(self._log_failure, 'Adding torrents failed')
+        d.addBoth(lambda ignore: self._adding.difference_update(torrents))
+        return d
+
+    @staticmethod
+    def _connect():
+        if client.connected():
+            return defer.succeed(None)
+        LOGGER.info('Connecting to deluge')
+        # Torrents may have been added or removed in deluge while disconnected
+        deluge_torrent_adder.forget_known_hashes()
+        return deluge_torrent_adder.connect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the torrent list generator and adder as one resident process')
+    parser.add_argument('--calendar-interval', type=float, default=CALENDAR_INTERVAL,
+                        help='seconds between calendar refreshes')
+    parser.add_argument('--search-interval', type=float, default=SEARCH_INTERVAL, help='seconds between searches')
+    parser.add_argument('--add-interval', type=float, default=ADD_INTERVAL,
+                        help='seconds between retries of pending adds')
+    args = parser.parse_args()
+
+    from log_config import configure_logging
+    configure_logging()
+    run(calendar_interval=args.calendar_interval, search_interval=args.search_interval,
+        add_interval=args.add_interval)
+
+
+def run(calendar_interval: float = CALENDAR_INTERVAL, search_interval: float = SEARCH_INTERVAL,
+        add_interval: float = ADD_INTERVAL):
+    daemon = AutoTorrentDaemon(calendar_interval=calendar_interval, search_interval=search_interval,
+                               add_interval=add_interval)
+    reactor.callWhenRunning(daemon.start)
+    with profiled('daemon'):
+        reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# Single entry point:
+#   autotorrent generate   search today's releases (torrent_list_generator)
+#   autotorrent add        send the pending torrents to deluge (deluge_torrent_adder)
+#   autotorrent run        resident mode doing both (auto_torrent_daemon)
+# Only the standard library is imported here, each subcommand imports its own subsystem when it runs.
+import sys
+import argparse
+
+from log_config import LOG_FILE, configure_logging
+
+
+def generate(args):
+    import torrent_list_generator
+    torrent_list_generator.main()
+
+
+def add(args):
+    import deluge_torrent_adder
+    deluge_torrent_adder.main()
+
+
+def run(args):
+    import auto_torrent_daemon
+    intervals = {name: value for name, value in vars(args).items() if name.endswith('_interval')}
+    auto_torrent_daemon.run(**intervals)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='autotorrent', description='Download the tv series airing today')
+    parser.add_argument('--log-file', default=LOG_FILE, help='rotating log file, empty to only log to the console')
+    parser.add_argument('--log-level', default='INFO')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    subparsers.add_parser('generate', help="search today's releases and store the torrents found") \
+        .set_defaults(func=generate)
+    subparsers.add_parser('add', help='send the best torrent of each pending episode to deluge') \
+        .set_defaults(func=add)
+
+    run_parser = subparsers.add_parser('run', help='stay resident and run generate and add on a schedule')
+    run_parser.set_defaults(func=run)
+    # Left out when not given, so the daemon's own defaults apply
+    run_parser.add_argument('--calendar-interval', type=float, default=argparse.SUPPRESS,
+                            help='seconds between calendar refreshes')
+    run_parser.add_argument('--search-interval', type=float, default=argparse.SUPPRESS,
+                            help='seconds between searches')
+    run_parser.add_argument('--add-interval', type=float, default=argparse.SUPPRESS,
+                            help='seconds between retries of pending adds')
+    return parser
+
+
+def main(argv: list = None):
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_file, args.log_level)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
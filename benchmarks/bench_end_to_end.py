@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# Benchmark: torrent_list_generator.main then deluge_torrent_adder.main, offline, at several scales.
+#   python3 benchmarks/bench_end_to_end.py [--episodes 10,100,1000,10000] [--indexer-latency 0.005] ...
+# Each scale runs in its own process (the twisted reactor can't be restarted and peak RSS is per process)
+# against a generated calendar, a fake indexer and a stand-in deluged replaying recorded answers.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ['calendar_parse', 'indexer_search', 'title_parse', 'rank_batch', 'deluge_add']
+
+
+def run_scale(args) -> dict:
+    # State, caches and metrics of the run, left behind for a look at <work_dir>/metrics
+    work_dir = tempfile.mkdtemp(prefix='auto_torrent_bench_')
+    # Read when metrics is imported
+    os.environ['AUTO_TORRENT_METRICS_DIR'] = os.path.join(work_dir, 'metrics')
+
+    import rarbgapi
+    import deluge_torrent_adder
+    import indexers
+    import torrent_list_generator
+    from fakes import FakeDelugeDaemon, FakeHttpClient, FakeRarbgAPI
+    from fixtures import make_pog_calendar_html
+    from metrics import METRICS
+
+    logging.getLogger().setLevel(args.log_level)
+
+    FakeRarbgAPI.LATENCY = args.indexer_latency
+    FakeRarbgAPI.RESULTS = args.results
+    rarbgapi.RarbgAPI = FakeRarbgAPI
+    indexers.RarbgIndexer.REQUESTS_PER_SECOND = args.rate
+
+    today = datetime.date.today()
+    http_client = FakeHttpClient(make_pog_calendar_html(today.year, today.month, args.episodes_per_day,
+                                                        today=today, today_episodes=args.episodes))
+    torrent_list_generator.get_http_client = lambda: http_client
+    torrent_list_generator.__location__ = work_dir
+    torrent_list_generator.search_cache_file_name = os.path.join(work_dir, 'search_cache.pickle')
+    torrent_list_generator.pog_calendar_file_name = os.path.join(work_dir, 'pog_calendar.pickle')
+    deluge_torrent_adder.__location__ = work_dir
+    # The real deluge client, over TLS on a loopback port
+    daemon = FakeDelugeDaemon(args.deluge_latency).start()
+    deluge_torrent_adder.DELUGE_PORT = daemon.port
+    deluge_torrent_adder.DELUGE_USERNAME = daemon.username
+    deluge_torrent_adder.DELUGE_PASSWORD = daemon.password
+
+    start = time.perf_counter()
+    torrent_list_generator.main()
+    generator_time = time.perf_counter() - start
+    start = time.perf_counter()
+    deluge_torrent_adder.main()
+    adder_time = time.perf_counter() - start
+
+    stages = METRICS.summary()['stages']
+    return {
+        'episodes': args.episodes,
+        'work_dir': work_dir,
+        'generator_seconds': generator_time,
+        'adder_seconds': adder_time,
+        'episodes_per_second': args.episodes / (generator_time + adder_time),
+        'indexer_calls': sum(value for name, value in METRICS.summary()['counters'].items()
+                             if name.startswith('indexer_api_calls')),
+        'added': len(daemon.torrents),
+        'deluge_max_in_flight': daemon.max_in_flight,
+        'p95': {stage: stages[stage]['p95'] for stage in STAGES if stage in stages},
+        # KiB on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(results: list):
+    print('{:>8s} {:>10s} {:>10s} {:>10s} {:>8s} {:>9s}  {}'.format(
+        'episodes', 'gen s', 'add s', 'eps/s', 'added', 'rss MB', 'p95 ms'))
+    for result in results:
+        print('{episodes:>8d} {generator_seconds:>10.2f} {adder_seconds:>10.2f} {episodes_per_second:>10.1f} '
+              '{added:>8d} {peak_rss_mb:>9.1f}  {stages}'.format(
+                  stages=' '.join('{}={:.1f}'.format(stage, seconds * 1000)
+                                  for stage, seconds in result['p95'].items()),
+                  **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end to end benchmark of the generator and the adder')
+    parser.add_argument('--episodes', default='10,100,1000,10000', help='comma separated episodes released today')
+    parser.add_argument('--episodes-per-day', type=int, default=40, help='episodes on every other calendar day')
+    parser.add_argument('--indexer-latency', type=float, default=0.005, help='seconds per fake indexer search')
+    parser.add_argument('--results', type=int, default=8, help='results per fake indexer search')
+    parser.add_argument('--rate', type=float, default=1000.0, help='indexer requests per second allowed')
+    parser.add_argument('--deluge-latency', type=float, default=0.005, help='seconds the fake deluged takes to answer')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    scales = [int(episodes) for episodes in args.episodes.split(',')]
+    if len(scales) == 1 and os.environ.get('AUTO_TORRENT_BENCH_CHILD'):
+        args.episodes = scales[0]
+        print(json.dumps(run_scale(args)))
+        return
+
+    results = []
+    for episodes in scales:
+        command = [sys.executable, os.path.abspath(__file__)] + \
+                  [arg for arg in sys.argv[1:] if not arg.startswith('--episodes=')] + \
+                  ['--episodes={}'.format(episodes)]
+        if '--episodes' in command:
+            # Drop the "--episodes <list>" form, the scale is passed as --episodes=<n>
+            index = command.index('--episodes')
+            del command[index:index + 2]
+        output = subprocess.run(command, env=dict(os.environ, AUTO_TORRENT_BENCH_CHILD='1'), check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# Benchmark: search latency of the indexer pool with one and several backends, a backend with a long tail
+# with and without hedged requests, a backend that never answers in time and one that hangs on well past
+# the pool giving up on it, holding on to its threads.
+#   python3 benchmarks/bench_indexers.py [--searches 200] [--slow-every 10] [--slow-latency 1.0] ...
+# Every backend is local: the fake torrentapi client, a torznab server on localhost and a releases file.
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rarbgapi  # noqa: E402
+
+from fakes import FakeRarbgAPI, FakeTorznabServer  # noqa: E402
+from metrics import METRICS  # noqa: E402
+
+rarbgapi.RarbgAPI = FakeRarbgAPI
+
+from indexers import IndexerPool, LocalFileIndexer, RarbgIndexer, TorznabIndexer  # noqa: E402
+
+
+def write_releases(file_name: str, search_strings: list):
+    # Every other search has its releases in the file as well
+    releases = [{'title': raw['title'], 'magnet': raw['download'], 'link': raw['info_page'], 'size': raw['size'],
+                 'seeders': raw['seeders']}
+                for search_string in search_strings[::2] for raw in FakeRarbgAPI.make_results(search_string)]
+    with open(file_name, 'w') as releases_out:
+        json.dump(releases, releases_out)
+
+
+def counter(name: str) -> float:
+    return sum(value for key, value in METRICS.summary()['counters'].items() if key.startswith(name))
+
+
+def run(name: str, indexers: list, search_strings: list):
+    METRICS.reset()
+    pool = IndexerPool(indexers, max_workers=4)
+    latencies = []
+    results = 0
+    for search_string in search_strings:
+        start = time.perf_counter()
+        merged, complete = pool.search(search_string, retries=1)
+        latencies.append(time.perf_counter() - start)
+        results += len(merged)
+    latencies.sort()
+    print('{:<28s} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7d} {:>7.0f} {:>7.0f} {:>7.0f}'.format(
+        name, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+        latencies[-1] * 1000, sum(latencies), results, counter('indexer_duplicates'),
+        counter('indexer_hedged_requests'), counter('indexer_timeouts')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the indexer fan-out')
+    parser.add_argument('--searches', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per search of every backend')
+    parser.add_argument('--slow-every', type=int, default=10, help='one torznab request in this many is slow')
+    parser.add_argument('--slow-latency', type=float, default=1.0, help='seconds a slow torznab request takes')
+    parser.add_argument('--hedge-after', type=float, default=0.05, help='seconds before a hedged torznab request')
+    parser.add_argument('--timeout', type=float, default=0.5, help='seconds before a backend is given up on')
+    parser.add_argument('--hang-latency', type=float, default=10.0, help='seconds a hung torrentapi search takes')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    FakeRarbgAPI.LATENCY = args.latency
+    search_strings = ['Series {} s01'.format(i) for i in range(args.searches)]
+    releases_file_name = os.path.join(tempfile.mkdtemp(prefix='auto_torrent_indexers_'), 'releases.json')
+    write_releases(releases_file_name, search_strings)
+
+    fast = FakeTorznabServer(args.latency).start()
+    slow = FakeTorznabServer(args.latency, args.slow_every, args.slow_latency).start()
+    stalled = FakeTorznabServer(args.slow_latency).start()
+
+    def rarbg():
+        return RarbgIndexer(retries=1, requests_per_second=10000)
+
+    def hung_rarbg():
+        indexer = RarbgIndexer(retries=1, requests_per_second=10000, timeout=args.timeout)
+        indexer._client.LATENCY = args.hang_latency
+        return indexer
+
+    def local():
+        return LocalFileIndexer(path=releases_file_name)
+
+    def torznab(server, **kwargs):
+        return TorznabIndexer('torznab', server.url, timeout=args.timeout, **kwargs)
+
+    print('{:<28s} {:>8s} {:>8s} {:>8s} {:>8s} {:>7s} {:>7s} {:>7s} {:>7s}'.format(
+        'backends', 'p50 ms', 'p95 ms', 'max ms', 'total s', 'results', 'dups', 'hedged', 'timeout'))
+    run('rarbg', [rarbg()], search_strings)
+    run('rarbg+torznab+local', [rarbg(), torznab(fast), local()], search_strings)
+    run('+slow torznab, no hedging', [rarbg(), torznab(slow, hedge_after=0), local()], search_strings)
+    run('+slow torznab, hedged', [rarbg(), torznab(slow, hedge_after=args.hedge_after), local()], search_strings)
+    run('+stalled torznab', [rarbg(), torznab(stalled, hedge_after=0), local()], search_strings[:20])
+    run('hung rarbg+torznab+local', [hung_rarbg(), torznab(fast), local()], search_strings[:20])
+
+    for server in (fast, slow, stalled):
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
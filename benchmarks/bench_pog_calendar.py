@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# Benchmark: lxml PogCalendar.parse against the BeautifulSoup parser it replaced.
+#   python3 benchmarks/bench_pog_calendar.py [fixture file] [iterations]
+# Both parsers must agree on every recorded calendar page in benchmarks/fixtures (see fixtures.py record),
+# the generated page is only used for timings when there is none.
+import os
+import sys
+import time
+
+import arrow
+import bs4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import load_fixture, recorded_fixtures  # noqa: E402
+from records import Episode  # noqa: E402
+from torrent_list_generator import PogCalendar  # noqa: E402
+
+GENERATED_FIXTURE = 'generated_pog_calendar_2020_10.html'
+
+
+class LegacyPogCalendar:
+    # Copy of the bs4 based PogCalendar
+
+    def __init__(self):
+        self._month_releases = []
+
+    def parse(self, html_data):
+        soup_obj = bs4.BeautifulSoup(html_data.text, features="lxml")
+        for div_day in soup_obj.find_all('div', {"class": {'today', 'day'}}):
+            date = arrow.get(div_day.select('a')[0].get(
+                'title'), "dddd Do MMMM YYYY").date()
+            day_releases = {'day': date, 'episodes': []}
+            for div_ep in div_day.select('div'):
+                last_ep = True if 'lastep' in div_ep.select(
+                    'span')[0].get('class') else False
+                first_ep = True if 'firstep' in div_ep.select(
+                    'span')[0].get('class') else False
+                series_ref = div_ep.select(
+                    'input')[0].get('value').split('-')[0]
+                series_name, ep_num, ep_title, series_provider = [line.strip() for line in
+                                                                  div_ep.text.strip().split("\n")]
+                series_provider = series_provider.split('-')[0].strip()
+                episode = {'name': series_name, 'number': ep_num,
+                           'provider': series_provider, 'series_ref': series_ref,
+                           'last_ep': last_ep, 'first_ep': first_ep}
+                day_releases['episodes'].append(episode)
+            self._month_releases.append(day_releases)
+
+    def get_releases(self, day) -> list:
+        return next(x for x in self._month_releases if x['day'] == day)['episodes']
+
+
+def run(name: str, fn, iterations: int):
+    start = time.perf_counter()
+    for i in range(iterations):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / iterations
+    print('{:<28s} {:>10.3f} ms/op'.format(name, elapsed * 1000))
+    return result
+
+
+def check_agreement(file_name: str):
+    legacy = LegacyPogCalendar()
+    legacy.parse(load_fixture(file_name))
+    current = PogCalendar()
+    current.parse(load_fixture(file_name))
+    # The legacy parser builds dict episodes
+    legacy_releases = [dict(day, episodes=[Episode.from_json(episode) for episode in day['episodes']])
+                       for day in legacy._month_releases]
+    assert current.get_month_releases(), '{}: no releases parsed'.format(file_name)
+    assert legacy_releases == current.get_month_releases(), '{}: parsers disagree'.format(file_name)
+    print('{}: parsers agree on {} episodes'.format(
+        file_name, sum(len(day['episodes']) for day in legacy_releases)))
+
+
+def main():
+    recorded = recorded_fixtures()
+    for file_name in recorded:
+        check_agreement(file_name)
+    if not recorded:
+        print('No recorded calendar page, run "python3 benchmarks/fixtures.py record" for one. The parsers '
+              'are only compared on generated markup.')
+        check_agreement(GENERATED_FIXTURE)
+
+    default_fixture = recorded[-1] if recorded else GENERATED_FIXTURE
+    fixture = load_fixture(sys.argv[1] if len(sys.argv) > 1 else default_fixture)
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    def parse(calendar_class):
+        calendar = calendar_class()
+        calendar.parse(fixture)
+        return calendar
+
+    legacy = run('bs4 parse', lambda: parse(LegacyPogCalendar), iterations)
+    current = run('lxml parse', lambda: parse(PogCalendar), iterations)
+    days = [day['day'] for day in current.get_month_releases()]
+    print('{} days, {} episodes'.format(len(days), sum(len(d['episodes']) for d in current.get_month_releases())))
+
+    lookups = days * 200
+    run('bs4 day lookups', lambda: [legacy.get_releases(day) for day in lookups], 1)
+    run('indexed day lookups', lambda: [current.get_releases(day) for day in lookups], 1)
+
+if __name__ == '__main__':
+    main()
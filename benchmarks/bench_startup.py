@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Benchmark: interpreter startup and import cost of the entry points, from python -X importtime, and a whole
+# "autotorrent add" run against a stand-in deluged on a loopback port.
+#   python3 benchmarks/bench_startup.py [repository dir] [runs]
+# Point it at an older checkout (e.g. a git worktree) to compare. Subcommands run in a copy of the checkout,
+# so their state store and metrics end up in a temporary directory.
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+# Seconds before a target is given up on
+TIMEOUT = 30
+# Modules that should only be loaded by the subcommands that need them
+HEAVY_MODULES = ['twisted', 'deluge', 'rarbgapi', 'lxml', 'bs4', 'arrow', 'requests', 'selenium', 'pdb', 'pprint']
+TARGETS = [
+    ('autotorrent --help', ['autotorrent.py', '--help']),
+    ('import torrent_list_generator', ['-c', 'import torrent_list_generator']),
+    ('import deluge_torrent_adder', ['-c', 'import deluge_torrent_adder']),
+    ('import auto_torrent_daemon', ['-c', 'import auto_torrent_daemon']),
+    # Nothing pending, so it connects, logs in, asks the daemon for its torrents and disconnects
+    ('autotorrent add', ['autotorrent.py', '--log-file=', '--log-level=WARNING', 'add']),
+]
+
+
+def start_deluge_daemon():
+    # Served by a reactor thread of this process, the subcommands connect from theirs
+    from twisted.internet import reactor
+    from fakes import FakeDelugeDaemon
+    daemon = FakeDelugeDaemon().start()
+    threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False}, daemon=True).start()
+    return daemon
+
+
+def copy_checkout(repository_dir: str) -> str:
+    work_dir = tempfile.mkdtemp(prefix='auto_torrent_startup_')
+    shutil.copytree(repository_dir, os.path.join(work_dir, 'checkout'),
+                    ignore=shutil.ignore_patterns('.git', '*.sqlite*', '*.pickle', 'metrics'))
+    return os.path.join(work_dir, 'checkout')
+
+
+def import_times(repository_dir: str, arguments: list, env: dict = None) -> tuple:
+    # (wall seconds, total import seconds, {package: cumulative import seconds}), None when the command failed
+    if not arguments[0].startswith('-') and not os.path.isfile(os.path.join(repository_dir, arguments[0])):
+        return None
+    start = time.perf_counter()
+    try:
+        # Older checkouts' adders never stop when they can't reach the daemon (they ignore the port given)
+        result = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=repository_dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                                timeout=TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return None
+    wall = time.perf_counter() - start
+    if result.returncode != 0 and '--help' not in arguments:
+        return None
+    total = 0.0
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        cumulative = int(cumulative_us) / 1e6
+        # Imports are indented under the module that triggered them, the top level ones add up to the total
+        if not name[1:].startswith(' '):
+            total += cumulative
+        package = name.strip().split('.')[0]
+        packages[package] = max(packages.get(package, 0.0), cumulative)
+    return wall, total, packages
+
+
+def main():
+    repository_dir = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else REPOSITORY_DIR
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(repository_dir)
+    daemon = start_deluge_daemon()
+    checkout_dir = copy_checkout(repository_dir)
+    env = dict(os.environ, AUTO_TORRENT_DELUGE_PORT=str(daemon.port), AUTO_TORRENT_DELUGE_USERNAME=daemon.username,
+               AUTO_TORRENT_DELUGE_PASSWORD=daemon.password,
+               AUTO_TORRENT_METRICS_DIR=os.path.join(checkout_dir, 'metrics'))
+    print('{:<32s} {:>9s} {:>11s}  {}'.format('target', 'wall ms', 'imports ms', 'heavy modules loaded'))
+    for name, arguments in TARGETS:
+        if arguments[0] == 'autotorrent.py' and '--help' not in arguments:
+            results = [import_times(checkout_dir, arguments, env) for run in range(runs)]
+        else:
+            results = [import_times(repository_dir, arguments) for run in range(runs)]
+        if any(result is None for result in results):
+            print('{:<32s} {:>9s}'.format(name, 'failed'))
+            continue
+        wall, total, packages = min(results, key=lambda result: result[0])
+        heavy = ['{} {:.0f}ms'.format(module, packages[module] * 1000) for module in HEAVY_MODULES
+                 if module in packages]
+        print('{:<32s} {:>9.1f} {:>11.1f}  {}'.format(name, wall * 1000, total * 1000, ', '.join(heavy) or '-'))
+    print('add runs in {}, the stand-in deluged has {} torrents'.format(checkout_dir, len(daemon.torrents)))
+
+
+if __name__ == '__main__':
+    main()
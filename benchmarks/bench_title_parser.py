@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# Micro-benchmark: TorrentTitleParser against the inline regexes it replaced.
+#   python3 benchmarks/bench_title_parser.py [corpus size] [distinct releases]
+# Runs on a corpus of distinct titles, where only the parse itself counts, and on one repeating a smaller
+# set of releases like search results do (every episode of a season sees the same season query results
+# and waiting-list episodes see them again on every run), where the cache does most of the work.
+import os
+import re
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from torrent_title_parser import TorrentTitleParser  # noqa: E402
+
+SHOWS = ['The.Mandalorian', 'Raised.by.Wolves', 'The.Boys', 'Star.Trek.Discovery', 'Fargo', 'His.Dark.Materials',
+         'The.Walking.Dead', 'Ted.Lasso', 'Lovecraft.Country', 'The.Expanse', 'Doctor.Who.2005', 'Bobs.Burgers']
+QUALITIES = ['', '720p.', '1080p.', '2160p.']
+RIP_TYPES = ['HDTV', 'WEB', 'WEB-DL', 'WEBRip', 'AMZN.WEB-DL', 'HMAX.WEB-DL']
+CODECS = ['x264', 'x265', 'H.264', 'HEVC']
+GROUPS = ['NTb', 'KILLERS', 'SVA', 'MZABI', 'ION10', 'TEPES', 'CAKES', 'GGEZ']
+
+
+def make_corpus(size: int, distinct: int, seed: int = 42, unique: bool = False) -> list:
+    rnd = random.Random(seed)
+    releases = []
+    for i in range(distinct):
+        # The release index in the group tag keeps every title of a unique corpus distinct
+        releases.append('{}.S{:02d}E{:02d}.{}{}.{}-{}{}'.format(
+            rnd.choice(SHOWS), rnd.randint(1, 15), rnd.randint(1, 24), rnd.choice(QUALITIES),
+            rnd.choice(RIP_TYPES), rnd.choice(CODECS), rnd.choice(GROUPS), i if unique else ''))
+    return releases if unique else [rnd.choice(releases) for i in range(size)]
+
+
+def legacy_parse(title: str) -> tuple:
+    # Copy of the code that used to live in Rarbg.get_today_torrent_releases
+    torrent_quality_re = re.compile(
+        r'(1080p|720p)', re.IGNORECASE)
+    quality = torrent_quality_re.search(title).group() if torrent_quality_re.search(
+        title) is not None else 'Standard'
+
+    torrent_rip_type_re = re.compile(
+        r'\.(HDTV|WEB[\w|-]*)\.', re.IGNORECASE)
+    rip_type = torrent_rip_type_re.search(title).group(1) if torrent_rip_type_re.search(
+        title) is not None else 'Undefined'
+    return quality, rip_type
+
+
+def run(name: str, parse, corpus: list):
+    start = time.perf_counter()
+    for title in corpus:
+        parse(title)
+    elapsed = time.perf_counter() - start
+    print('{:<28s} {:>9.3f}s {:>12,.0f} titles/s'.format(name, elapsed, len(corpus) / elapsed))
+
+
+def bench(corpus: list):
+    print('Corpus: {:,} titles, {:,} unique'.format(len(corpus), len(set(corpus))))
+    run('legacy inline regexes', legacy_parse, corpus)
+    # Bypass the memo to measure the parse on its own
+    run('parser, uncached', TorrentTitleParser._parse, corpus)
+    parser = TorrentTitleParser(cache_size=None)
+    run('parser, cold cache', parser.parse, corpus)
+    run('parser, warm cache', parser.parse, corpus)
+    print(parser.cache_info())
+    assert all(tuple(parser.parse(title)) == legacy_parse(title) for title in corpus), 'parsers disagree'
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else size // 20
+    bench(make_corpus(size, size, unique=True))
+    print()
+    bench(make_corpus(size, distinct))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+# Offline stand-ins for pogdesign, the torrentapi indexer, a torznab indexer and deluged, so the generator
+# and the adder can run end to end without touching the network.
+import os
+import json
+import time
+import random
+import datetime
+import hashlib
+import threading
+import http.server
+import urllib.parse
+from xml.sax.saxutils import escape, quoteattr
+
+import rarbgapi
+from deluge.transfer import DelugeTransferProtocol
+from deluge.ui.client import RPC_ERROR, RPC_RESPONSE
+from twisted.internet import reactor, ssl
+from twisted.internet.protocol import Factory
+
+from fixtures import DELUGE_FIXTURE, FIXTURES_DIR, FixtureResponse
+from info_hash import parse_info_hash
+from torrent_title_parser import split_series_name
+
+QUALITIES = ['2160p', '1080p', '720p', '']
+RIP_TYPES = ['WEB', 'WEBRip', 'HDTV', 'AMZN.WEB-DL']
+GROUPS = ['NTb', 'CAKES', 'GGEZ', 'ION10', 'TEPES']
+
+
+class FakeHttpClient:
+    # Serves one calendar page for every url, the interface get_pog_calendar uses from HttpClient
+
+    def __init__(self, html: str):
+        self._html = html
+        self.requests = 0
+
+    def load_cookies(self, file_name: str) -> dict:
+        return {}
+
+    def get(self, url: str, cookies: dict = None, use_cache: bool = True, **kwargs):
+        self.requests += 1
+        return FixtureResponse(self._html)
+
+    def stats(self) -> dict:
+        return {'requests': self.requests}
+
+    def log_stats(self):
+        pass
+
+
+class FakeRarbgAPI(rarbgapi.RarbgAPI):
+    # Answers searches with made up extended results. Season searches ("Show s01") get releases of random
+    # episodes of the season, never season packs, like a weekly show.
+    LATENCY = 0.005
+    RESULTS = 8
+    SEED = 42
+
+    def __init__(self, retries: int = 3, **kwargs):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def search(self, search_string: str = None, categories=None, extended_response: bool = False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.LATENCY)
+        return [rarbgapi.Torrent(raw) for raw in self.make_results(search_string)]
+
+    @classmethod
+    def make_results(cls, search_string: str) -> list:
+        series_name, number = search_string.rsplit(' ', 1)
+        # Seeded by the query, so every run of the benchmark sees the same results
+        rnd = random.Random('{}:{}'.format(cls.SEED, search_string))
+        numbers = [number if len(number) > 3 else '{}e{:02d}'.format(number, rnd.randint(1, 10))
+                   for i in range(cls.RESULTS)]
+        return [cls._make_raw(rnd, series_name, number) for number in numbers]
+
+    @staticmethod
+    def _make_raw(rnd: random.Random, series_name: str, number: str) -> dict:
+        title = '.'.join(part for part in ['.'.join(split_series_name(series_name)), number.upper(),
+                                           rnd.choice(QUALITIES), rnd.choice(RIP_TYPES), 'x264'] if part)
+        title = '{}-{}'.format(title, rnd.choice(GROUPS))
+        info_hash = hashlib.sha1('{}{}'.format(title, rnd.random()).encode('utf-8')).hexdigest()
+        return {'title': title, 'category': 'TV HD Episodes', 'download': 'magnet:?xt=urn:btih:' + info_hash,
+                'seeders': rnd.randint(0, 5000), 'leechers': rnd.randint(0, 500),
+                'size': rnd.randint(200, 4000) * 1024 * 1024, 'pubdate': '2020-10-01 00:00:00 +0000',
+                'info_page': 'https://torrentapi.org/redirect_to_info.php?p=' + info_hash[:8]}
+
+
+def make_torznab_xml(raws: list) -> str:
+    items = ''.join(
+        '<item><title>{title}</title><comments>{info_page}</comments><size>{size}</size>'
+        '<torznab:attr name="seeders" value="{seeders}"/><torznab:attr name="magneturl" value={magnet}/></item>'
+        .format(magnet=quoteattr(raw['download']), **dict(raw, title=escape(raw['title']),
+                                                           info_page=escape(raw['info_page'])))
+        for raw in raws)
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<rss version="2.0" xmlns:torznab="http://torznab.com/schemas/2015/feed">'
+            '<channel><title>fake</title>{}</channel></rss>'.format(items))
+
+
+class FakeTorznabServer:
+    # A torznab api on localhost answering with the releases FakeRarbgAPI makes up for the same search, so
+    # the two indexers overlap completely. Every slow_every-th request takes slow_latency instead of latency,
+    # like a backend with a long tail.
+
+    def __init__(self, latency: float = 0.005, slow_every: int = 0, slow_latency: float = 1.0):
+        self.latency = latency
+        self.slow_every = slow_every
+        self.slow_latency = slow_latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}/api'.format(self._httpd.server_address[1])
+
+    def start(self) -> 'FakeTorznabServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _handle(self, request: http.server.BaseHTTPRequestHandler):
+        with self._lock:
+            self.requests += 1
+            slow = self.slow_every and self.requests % self.slow_every == 0
+        time.sleep(self.slow_latency if slow else self.latency)
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(request.path).query)
+        body = make_torznab_xml(FakeRarbgAPI.make_results(query['q'][0])).encode('utf-8')
+        try:
+            request.send_response(200)
+            request.send_header('Content-Type', 'application/rss+xml')
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting
+            pass
+
+
+class FakeDelugeDaemon:
+    # deluged's rpc server on a loopback port, for the real deluge client. It speaks the same protocol over
+    # TLS and answers with what a real deluged answered the same calls with (benchmarks/fixtures.py
+    # record-deluge), the recorded info hash swapped for the one of each add. Every answer goes out after
+    # latency seconds, while the daemon keeps taking requests.
+
+    def __init__(self, latency: float = 0.005, username: str = 'bench', password: str = 'bench',
+                 fixture: str = DELUGE_FIXTURE):
+        self.latency = latency
+        self.username = username
+        self.password = password
+        self.torrents = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        with open(os.path.join(FIXTURES_DIR, fixture), encoding='utf-8') as fixture_in:
+            exchanges = json.load(fixture_in)
+        # method -> recorded answers, in the order they were given
+        self._recorded = {}
+        for exchange in exchanges:
+            self._recorded.setdefault(exchange['method'], []).append(exchange)
+        self._port = None
+
+    @property
+    def port(self) -> int:
+        return self._port.getHost().port
+
+    def start(self) -> 'FakeDelugeDaemon':
+        self._port = reactor.listenSSL(0, Factory.forProtocol(lambda: _FakeDelugeProtocol(self)),
+                                       _self_signed_certificate().options(), interface='127.0.0.1')
+        return self
+
+    def stop(self):
+        return self._port.stopListening()
+
+    def _replay(self, method: str, request_id: int, recorded_hash: str = None, info_hash: str = None,
+                error: bool = False) -> list:
+        exchange = next(exchange for exchange in self._recorded[method]
+                        if (exchange['response'][0] == RPC_ERROR) == error)
+        response = json.dumps(exchange['response'])
+        if recorded_hash is not None:
+            response = response.replace(recorded_hash, info_hash)
+        return [exchange['response'][0], request_id] + json.loads(response)[2:]
+
+    def answer(self, request_id: int, method: str, args: list, kwargs: dict) -> list:
+        if method == 'daemon.login':
+            if list(args) != [self.username, self.password]:
+                return [RPC_ERROR, request_id, 'BadLoginError', ['Password does not match', args[0]], {}, '']
+            return self._replay(method, request_id)
+        if method == 'core.add_torrent_magnet':
+            recorded_hash = parse_info_hash(self._recorded[method][0]['args'][0])
+            info_hash = parse_info_hash(args[0])
+            if info_hash in self.torrents:
+                return self._replay(method, request_id, recorded_hash, info_hash, error=True)
+            self.torrents[info_hash] = args[0]
+            return self._replay(method, request_id, recorded_hash, info_hash)
+        if method == 'core.get_torrents_status':
+            recorded_hash, status = next(iter(self._recorded[method][0]['response'][2].items()))
+            status = json.dumps(status)
+            return [RPC_RESPONSE, request_id, {info_hash: json.loads(status.replace(recorded_hash, info_hash))
+                                               for info_hash in self.torrents}]
+        if method in self._recorded:
+            return self._replay(method, request_id)
+        # What deluged sends for a method it doesn't have
+        return [RPC_ERROR, request_id, 'WrappedException',
+                ['RPC call on invalid function: {}'.format(method), 'AttributeError', ''], {}, '']
+
+
+class _FakeDelugeProtocol(DelugeTransferProtocol):
+
+    def __init__(self, daemon: FakeDelugeDaemon):
+        super().__init__()
+        self._daemon = daemon
+
+    def message_received(self, requests):
+        # The client sends a tuple of (request id, method, args, kwargs)
+        for request in requests:
+            adding = request[1] == 'core.add_torrent_magnet'
+            if adding:
+                self._daemon.in_flight += 1
+                self._daemon.max_in_flight = max(self._daemon.max_in_flight, self._daemon.in_flight)
+            reactor.callLater(self._daemon.latency, self._answer, request, adding)
+
+    def _answer(self, request, adding: bool):
+        if adding:
+            self._daemon.in_flight -= 1
+        if self.transport.connected:
+            self.transfer_message(tuple(self._daemon.answer(*request)))
+
+
+def _self_signed_certificate() -> ssl.PrivateCertificate:
+    # The deluge client doesn't verify the daemon's certificate, but it only connects over TLS
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+    return ssl.PrivateCertificate.loadPEM(
+        certificate.public_bytes(serialization.Encoding.PEM) +
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                          serialization.NoEncryption()))
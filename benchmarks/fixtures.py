@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# Calendar fixtures for PogCalendar.parse.
+#   python3 benchmarks/fixtures.py record [year] [month]
+# saves pogdesign.co.uk/cat/<month>-<year> as benchmarks/fixtures/recorded_pog_calendar_<year>_<month>.html,
+# without scripts, comments, forms fields other than the episode checkboxes and cookies (none are sent).
+#   python3 benchmarks/fixtures.py [year] [month] [episodes per day]
+# writes a generated calendar, benchmarks/fixtures/generated_pog_calendar_<year>_<month>.html. Generated
+# markup is what the lxml parser was written against, only recorded pages tell whether it reads real ones.
+#   python3 benchmarks/fixtures.py record-deluge [host] [port] [username] [password]
+# saves what a real deluged answers the adder's calls with as benchmarks/fixtures/recorded_deluge_rpc.json,
+# for FakeDelugeDaemon to replay. It adds RECORDED_MAGNET to the daemon, twice, and removes it again.
+import os
+import sys
+import json
+import random
+import calendar
+import datetime
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+RECORDED_PREFIX = 'recorded_'
+RECORDED_POG_CALENDAR_PREFIX = RECORDED_PREFIX + 'pog_calendar_'
+POG_CALENDAR_URL = 'https://www.pogdesign.co.uk/cat/{}-{}'
+DELUGE_FIXTURE = RECORDED_PREFIX + 'deluge_rpc.json'
+RECORDED_MAGNET = 'magnet:?xt=urn:btih:c9e15763f722f23e98a29decdfae341b98d53056&dn=AutoTorrent.S01E01.720p.WEB.x264-NTb'
+
+SERIES = ['Raised by Wolves', 'The Mandalorian', 'The Boys', 'Star Trek: Discovery', 'Fargo',
+          'His Dark Materials', 'The Walking Dead', 'Ted Lasso', 'Lovecraft Country', 'The Expanse',
+          'Doctor Who', "Bob's Burgers", 'The Simpsons', 'Family Guy', 'Grey\'s Anatomy', 'Supernatural']
+PROVIDERS = ['HBO', 'Disney+', 'Netflix', 'AMC', 'FX', 'BBC One', 'Apple TV+', 'Amazon', 'FOX', 'The CW']
+
+
+def _ordinal(day: int) -> str:
+    if 11 <= day % 100 <= 13:
+        return '{}th'.format(day)
+    return '{}{}'.format(day, {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th'))
+
+
+def make_episodes(count: int, seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    episodes = []
+    for i in range(count):
+        series = rnd.choice(SERIES) if count <= len(SERIES) * 10 else '{} {}'.format(rnd.choice(SERIES), i)
+        episode = rnd.randint(1, 10)
+        episodes.append({'name': series, 'number': 's{:02d}e{:02d}'.format(rnd.randint(1, 8), episode),
+                         'provider': rnd.choice(PROVIDERS), 'series_ref': str(1000 + i),
+                         'first_ep': episode == 1, 'last_ep': episode == 10})
+    return episodes
+
+
+def make_pog_calendar_html(year: int, month: int, episodes_per_day: int, seed: int = 42, today=None,
+                           today_episodes: int = None) -> str:
+    # today_episodes overrides episodes_per_day on the today cell, to scale the generator's workload alone
+    rnd = random.Random(seed)
+    parts = ['<html><head><title>TV Calendar</title></head><body><div id="month_box">']
+    for day in range(1, calendar.monthrange(year, month)[1] + 1):
+        date = datetime.date(year, month, day)
+        css_class = 'today' if date == today else 'day'
+        parts.append('<div class="{}" id="d_{}_{}_{}">'.format(css_class, day, month, year))
+        parts.append('<a class="daylink" href="/cat/day/{0}-{1}-{2}" title="{3} {4} {5} {2}">{0}</a>'.format(
+            day, month, year, date.strftime('%A'), _ordinal(day), date.strftime('%B')))
+        count = today_episodes if date == today and today_episodes is not None else episodes_per_day
+        for episode in make_episodes(count, seed=rnd.random()):
+            span_class = 'firstep' if episode['first_ep'] else 'lastep' if episode['last_ep'] else 'ep'
+            parts.append(
+                '<div class="ep info"><span class="{0}"></span>'
+                '<input type="checkbox" value="{1}-{2}" name="ep" />\n'
+                '<p><a href="/cat/{5}-summary">{3}</a></p>\n'
+                '<a class="eplink" href="/cat/{5}/{4}">{4}</a>\n'
+                '<span class="eptitle">Episode {2}</span>\n'
+                '<span class="prov">{6} - 9:00 pm</span></div>'.format(
+                    span_class, episode['series_ref'], rnd.randint(10000, 99999), episode['name'],
+                    episode['number'], episode['name'].lower().replace(' ', '-'), episode['provider']))
+        parts.append('</div>')
+    parts.append('</div></body></html>')
+    return ''.join(parts)
+
+
+class FixtureResponse:
+    # Enough of a requests.Response for PogCalendar.parse and get_pog_calendar
+
+    def __init__(self, text: str, status_code: int = 200):
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.status_code = status_code
+        self.headers = {}
+        self.from_cache = False
+
+    def raise_for_status(self):
+        pass
+
+
+def load_fixture(file_name: str) -> FixtureResponse:
+    with open(os.path.join(FIXTURES_DIR, file_name), encoding='utf-8') as fixture:
+        return FixtureResponse(fixture.read())
+
+
+def recorded_fixtures() -> list:
+    # The recorded calendar pages
+    return sorted(file_name for file_name in os.listdir(FIXTURES_DIR)
+                  if file_name.startswith(RECORDED_POG_CALENDAR_PREFIX))
+
+
+def sanitise_page(html: str) -> str:
+    # Drops everything tied to a session or of no use to the calendar parsers
+    import lxml.html
+    document = lxml.html.fromstring(html)
+    for element in document.xpath('//script | //noscript | //iframe | //comment() | //meta | //link | '
+                                  '//input[not(@name="ep")] | //form//*[@name="token" or @name="csrf"]'):
+        element.drop_tree()
+    for element in document.xpath('//*[@onclick or @data-user or @data-session]'):
+        for attribute in ('onclick', 'data-user', 'data-session'):
+            element.attrib.pop(attribute, None)
+    return lxml.html.tostring(document, encoding='unicode', doctype='<!DOCTYPE html>')
+
+
+def record_pog_calendar(year: int, month: int) -> str:
+    import requests
+    # A fresh session, so no cookie of a logged in account ends up in the page
+    response = requests.get(POG_CALENDAR_URL.format(month, year), headers={'User-Agent': 'Mozilla/5.0'},
+                            timeout=30)
+    response.raise_for_status()
+    file_name = os.path.join(FIXTURES_DIR, '{}{}_{:02d}.html'.format(RECORDED_POG_CALENDAR_PREFIX, year, month))
+    with open(file_name, 'w', encoding='utf-8') as fixture:
+        fixture.write(sanitise_page(response.text))
+    return file_name
+
+
+def record_deluge_rpc(host: str, port: int, username: str, password: str) -> str:
+    # The messages of every request and answer, decoded but otherwise as they went over the wire:
+    # [{"method", "args", "kwargs", "response": [message type, request id, ...]}, ...]
+    from deluge.ui import client as deluge_client
+    from twisted.internet import reactor
+
+    exchanges = []
+    sent = {}
+    protocol = deluge_client.DelugeRPCProtocol
+    send_request, message_received = protocol.send_request, protocol.message_received
+
+    def recording_send_request(self, request):
+        args = list(request.args)
+        if request.method == 'daemon.login':
+            args[1:2] = ['***']
+        sent[request.request_id] = {'method': request.method, 'args': args, 'kwargs': dict(request.kwargs)}
+        send_request(self, request)
+
+    def recording_message_received(self, message):
+        if message[0] != deluge_client.RPC_EVENT:
+            exchanges.append(dict(sent[message[1]], response=list(message)))
+        message_received(self, message)
+
+    protocol.send_request, protocol.message_received = recording_send_request, recording_message_received
+    client = deluge_client.client
+
+    def on_connect(result):
+        d = client.core.add_torrent_magnet(RECORDED_MAGNET, {})
+        # Refused, it is in the session already
+        d.addCallback(lambda torrent_id: client.core.add_torrent_magnet(RECORDED_MAGNET, {})
+                      .addErrback(lambda failure: torrent_id))
+        d.addCallback(lambda torrent_id: client.core.get_torrents_status({}, ['hash'])
+                      .addCallback(lambda status: client.core.remove_torrent(torrent_id, False)))
+        return d
+
+    failures = []
+    d = client.connect(host, port, username, password)
+    d.addCallback(on_connect)
+    d.addErrback(failures.append)
+    d.addBoth(lambda ignore: client.disconnect() if client.connected() else None)
+    d.addBoth(lambda ignore: reactor.stop())
+    reactor.run()
+    protocol.send_request, protocol.message_received = send_request, message_received
+    if failures:
+        failures[0].raiseException()
+
+    file_name = os.path.join(FIXTURES_DIR, DELUGE_FIXTURE)
+    with open(file_name, 'w', encoding='utf-8') as fixture:
+        json.dump(exchanges, fixture, indent=2)
+    return file_name
+
+
+def main():
+    arguments = sys.argv[1:]
+    if arguments[:1] == ['record-deluge']:
+        defaults = ['127.0.0.1', '58846', '', '']
+        host, port, username, password = arguments[1:5] + defaults[len(arguments[1:5]):]
+        os.makedirs(FIXTURES_DIR, exist_ok=True)
+        print(record_deluge_rpc(host, int(port), username, password))
+        return
+    record = arguments[:1] == ['record']
+    if record:
+        arguments = arguments[1:]
+    today = datetime.date.today()
+    year = int(arguments[0]) if len(arguments) > 0 else 2020 if not record else today.year
+    month = int(arguments[1]) if len(arguments) > 1 else 10 if not record else today.month
+    episodes_per_day = int(arguments[2]) if len(arguments) > 2 else 40
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    if record:
+        print(record_pog_calendar(year, month))
+        return
+    file_name = os.path.join(FIXTURES_DIR, 'generated_pog_calendar_{}_{:02d}.html'.format(year, month))
+    with open(file_name, 'w', encoding='utf-8') as fixture:
+        fixture.write(make_pog_calendar_html(year, month, episodes_per_day))
+    print(file_name)
+
+
+if __name__ == '__main__':
+    main()
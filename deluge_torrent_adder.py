@@ -1,92 +1,197 @@
 #!/usr/bin/python3
 
 # Import the client module
-import json
-
-import bs4
 from deluge.ui.client import client
 # Import the reactor module from Twisted - this is for our mainloop
-from twisted.internet import reactor
-import requests
-import pickle
+from twisted.internet import reactor, defer, threads
 import re
 import os
-import logging.config
 import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-logging.config.dictConfig(config={
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'default': {
-            'format': '%(asctime)s: %(module)22s->%(funcName)-26s - [%(levelname)5s] - %(message)s',
-            'datefmt': '[%d-%m-%Y | %H:%M:%S]'
-        }
-    },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'default',
-            'level': 'DEBUG',
-        },
-        'file': {
-            'class': 'logging.handlers.TimedRotatingFileHandler',
-            'filename': '/var/log/auto_torrent/auto_torrent.log',
-            # 'filename': 'auto_torrent.log',
-            # 'mode': 'w',
-            'formatter': 'default',
-            'when': 'midnight',
-            'backupCount': 10,
-            'level': 'DEBUG'
-        },
-    },
-    'root': {
-        'handlers': ['file', 'console'],
-        'level': 'INFO',
-    },
-})
+from info_hash import parse_info_hash
+from metrics import METRICS, profiled
+from search_cache import SearchCache
+from state_store import open_state_store
+from torrent_ranker import TorrentRanker
 
 __location__ = os.path.realpath(os.path.join(
     os.getcwd(), os.path.dirname(__file__)))
-pickle_file_name = os.path.join(__location__, 'torrents.pickle')
 
 LOGGER = logging.getLogger(__name__)
+STORE = None
+
+# The daemon to add to. Without a username the client logs in as the localclient of deluge's auth file,
+# which only works with a daemon on this machine
+DELUGE_HOST = os.environ.get('AUTO_TORRENT_DELUGE_HOST', '127.0.0.1')
+DELUGE_PORT = int(os.environ.get('AUTO_TORRENT_DELUGE_PORT', 58846))
+DELUGE_USERNAME = os.environ.get('AUTO_TORRENT_DELUGE_USERNAME', '')
+DELUGE_PASSWORD = os.environ.get('AUTO_TORRENT_DELUGE_PASSWORD', '')
+
+# Adds waiting on the daemon at once, and how long a whole run may take
+MAX_IN_FLIGHT = 5
+ADD_TIMEOUT = 300
+# Seconds the disconnect may take, a run is stopped anyway after ADD_TIMEOUT + DISCONNECT_TIMEOUT
+DISCONNECT_TIMEOUT = 10
+
+RANKER = TorrentRanker()
+
+# Info hashes of the torrents the daemon has, fetched once per connection by get_known_hashes
+KNOWN_HASHES = None
+# Deferreds waiting on the get_torrents_status call in flight
+KNOWN_HASHES_WAITERS = None
+# Info hash -> torrents of other episodes waiting on the add of the same torrent, for every add in flight
+ADDS_IN_FLIGHT = {}
+
+# Refreshing seeders hits the info pages (behind threat defence), so it is off unless asked for. The
+# modules it needs are imported by the functions that use them, the adder alone doesn't load them.
+REFRESH_SEEDERS = False
+SEEDERS_WORKERS = 8
+SEEDERS_TTL = 10 * 60
+SEEDERS_NEGATIVE_TTL = 2 * 60
+SEEDERS_CACHE = None
+# Compiled by extract_seeders
+PEERS_XPATH = None
+SEEDERS_RE = re.compile(r'Seeders : (\d+)')
 
 
 # We create a callback function to be called upon a successful connection
 def on_connect_success(result):
     LOGGER.info("Connection was successful!")
+    # Selection may fetch info pages, so it runs off the reactor thread. Returning the Deferred keeps the
+    # connect() chain waiting until every add has resolved
+    d = get_known_hashes()
+    d.addCallback(lambda known_hashes: threads.deferToThread(get_torrents_to_add, STORE)
+                  .addCallback(add_torrents, STORE, known_hashes=known_hashes))
+    return d
+
+
+def connect():
+    return client.connect(DELUGE_HOST, DELUGE_PORT, DELUGE_USERNAME, DELUGE_PASSWORD)
+
+
+def get_known_hashes():
+    # One get_torrents_status call per connection, asking for nothing but the ids (the info hashes).
+    # Every magnet is then checked against the set without another rpc. Callers that come while the
+    # call is in flight wait for its answer instead of making their own.
+    global KNOWN_HASHES_WAITERS
+    if KNOWN_HASHES is not None:
+        return defer.succeed(KNOWN_HASHES)
+    d = defer.Deferred()
+    if KNOWN_HASHES_WAITERS is not None:
+        KNOWN_HASHES_WAITERS.append(d)
+        return d
+    KNOWN_HASHES_WAITERS = [d]
+
+    def on_status(status: dict):
+        global KNOWN_HASHES
+        KNOWN_HASHES = {torrent_id.lower() for torrent_id in status}
+        LOGGER.info("Daemon has {} torrents".format(len(KNOWN_HASHES)))
+        return KNOWN_HASHES
 
-    def on_torrent_added(torrent_id, torrent_title):
-        LOGGER.info("{} added to daemon!".format(torrent_title))
-        LOGGER.info("Torrent ID: {:s}".format(torrent_id))
+    def on_status_fail(result):
+        # Adding without the check is still better than not adding
+        LOGGER.info("Couldn't get the daemon's torrents: {}".format(result.getErrorMessage()))
+        return set()
 
-    def on_torrent_added_fail(result):
-        LOGGER.info(result)
+    def answer_waiters(known_hashes: set):
+        global KNOWN_HASHES_WAITERS
+        waiters, KNOWN_HASHES_WAITERS = KNOWN_HASHES_WAITERS, None
+        for waiter in waiters:
+            waiter.callback(known_hashes)
 
-    torrents_to_add = get_torrents_to_add()
+    client.core.get_torrents_status({}, ['hash']).addCallbacks(on_status, on_status_fail).addCallback(answer_waiters)
+    return d
+
+
+def forget_known_hashes():
+    # For a new connection, the daemon may have changed in between
+    global KNOWN_HASHES
+    KNOWN_HASHES = None
+
+
+def add_torrents(torrents_to_add: list, store, max_in_flight: int = MAX_IN_FLIGHT, known_hashes: set = None):
+    # At most max_in_flight add_torrent_magnet calls are waiting on the daemon at any time, the
+    # rest queue on the semaphore without blocking the reactor. Torrents whose info hash is in
+    # known_hashes are skipped without any rpc, the ones added go into it. A torrent already being
+    # added for another episode (in this batch or another) isn't sent again, its episode is marked
+    # added once that add succeeds.
+    semaphore = defer.DeferredSemaphore(max_in_flight)
+    known_hashes = set() if known_hashes is None else known_hashes
+
+    def on_torrent_added(torrent_id, torrent, start):
+        METRICS.observe('deluge_add', time.perf_counter() - start)
+        METRICS.inc('deluge_adds', result='added')
+        LOGGER.info("{} added to daemon!".format(torrent['title']))
+        LOGGER.info("Torrent ID: {}".format(torrent_id))
+        # Only forget about the episode once deluge has actually accepted it
+        store.mark_added(torrent['ep_name'])
+        return True
+
+    def on_torrent_added_fail(result, torrent, start):
+        METRICS.observe('deluge_add', time.perf_counter() - start)
+        METRICS.inc('deluge_adds', result='failed')
+        LOGGER.info("Failed to add {}: {}".format(torrent['title'], result.getErrorMessage()))
+        return False
+
+    def add(torrent):
+        start = time.perf_counter()
+        return client.core.add_torrent_magnet(torrent['magnet'], {}) \
+            .addCallbacks(on_torrent_added, on_torrent_added_fail, callbackArgs=(torrent, start),
+                          errbackArgs=(torrent, start))
+
+    def on_add_done(added, info_hash):
+        # A failure here is an add cancelled while it was queued
+        if added is True:
+            known_hashes.add(info_hash)
+        for torrent in ADDS_IN_FLIGHT.pop(info_hash):
+            if added is True:
+                METRICS.inc('deluge_adds', result='present')
+                LOGGER.info("{} was added for another episode".format(torrent['title']))
+                store.mark_added(torrent['ep_name'])
+            else:
+                LOGGER.info("{} stays pending, adding it for another episode failed".format(torrent['title']))
+        return added
+
+    adds = []
     for torrent in torrents_to_add:
-        client.core.add_torrent_magnet(torrent['magnet'], {}).addCallback(on_torrent_added, torrent['title']) \
-            .addErrback(on_torrent_added_fail)
-        time.sleep(0.2)
-    if os.path.isfile(pickle_file_name):
-        os.remove(pickle_file_name)
-        LOGGER.info("Torrents pickle file removed")
+        info_hash = parse_info_hash(torrent['magnet'])
+        if info_hash is not None and info_hash in known_hashes:
+            METRICS.inc('deluge_adds', result='present')
+            LOGGER.info("{} is already in the daemon".format(torrent['title']))
+            store.mark_added(torrent['ep_name'])
+            continue
+        if info_hash is not None and info_hash in ADDS_IN_FLIGHT:
+            ADDS_IN_FLIGHT[info_hash].append(torrent)
+            continue
+        d = semaphore.run(add, torrent)
+        if info_hash is not None:
+            ADDS_IN_FLIGHT[info_hash] = []
+            d.addBoth(on_add_done, info_hash)
+        adds.append(d)
+    return defer.DeferredList(adds, consumeErrors=True)
 
 
-def get_torrents_to_add() -> list:
-    torrents = {}
-    if os.path.isfile(pickle_file_name):
-        with open(pickle_file_name, "rb") as pickle_in:
-            torrents = pickle.load(pickle_in)
+def get_torrents_to_add(store, refresh_seeders: bool = REFRESH_SEEDERS) -> list:
+    return select_torrents(store.get_pending_torrents(), refresh_seeders)
 
+
+def select_torrents(torrents: dict, refresh_seeders: bool = REFRESH_SEEDERS) -> list:
     magnets = []
     LOGGER.info("------------------------------------------------")
-    for k, v in torrents.items():
-        #new_torrent_list = get_torrents_seeds(v)
-        magnet_title, magnet_link = get_best_torrent_option(v)
-        if magnet_title != '':
-            magnets.append({"title": magnet_title, "magnet": magnet_link})
+    if refresh_seeders:
+        with METRICS.timer('seeders_refresh'):
+            torrents = refresh_torrents_seeds(torrents)
+    with METRICS.timer('rank_batch'):
+        best_options = RANKER.rank_all(torrents)
+    METRICS.inc('ranked_candidates', sum(len(options) for options in torrents.values()))
+    for k in torrents:
+        best = best_options.get(k)
+        if best is not None:
+            LOGGER.info("Best option for {}: {} ({} seeders)".format(k, best.title, best.seeders))
+            magnets.append({"title": best.title, "magnet": best.magnet, "ep_name": k})
         else:
             LOGGER.info("No torrent to add for {:}".format(k))
         LOGGER.info("------------------------------------------------")
@@ -94,63 +199,94 @@ def get_torrents_to_add() -> list:
     return magnets
 
 
+@METRICS.timed('rank_episode')
 def get_best_torrent_option(torrent_options: list) -> tuple:
-    if len(torrent_options) > 0:
-        web_rel = [w for w in torrent_options if 'WEB'.casefold()
-                   in w.get('rip_type').casefold()]
-        hdtv_rel = [h for h in torrent_options if 'HDTV'.casefold()
-                    in h.get('rip_type').casefold()]
-
-        if len(web_rel) > 0:
-            web_rel.sort(key=lambda k: k['seeders'], reverse=True)
-            return web_rel[0].get('title'), web_rel[0].get('magnet')
-            # for web_t in web_rel:
-            #     if web_t.get('size') < 1500.0:
-            #         return web_t.get('title'), web_t.get('magnet')
-
-        elif len(hdtv_rel) > 0:
-            hdtv_rel.sort(key=lambda k: k['seeders'])
-            return hdtv_rel[0].get('title'), hdtv_rel[0].get('magnet')
-            # for hd_t in hdtv_rel:
-            #     if hd_t.get('size') < 1500.0:
-            #         return hd_t.get('title'), hd_t.get('magnet')
-
-        else:
-            torrent_options.sort(key=lambda k: k['seeders'], reverse=True)
-            return torrent_options[0].get('title'), torrent_options[0].get('magnet')
-            # for opt in torrent_options:
-            #     if opt.get('size') < 1500.0:
-            #         return opt.get('title'), opt.get('magnet')
+    best = RANKER.best(torrent_options)
+    if best is not None:
+        return best.title, best.magnet
 
     return '', ''
 
 
-def get_torrents_seeds(torrent_options: list) -> list:
-    with open(os.path.join(__location__, 'rarbg_cookie.json')) as cookie:
-        rarbg_cookie = json.load(cookie)
+def get_seeders_cache() -> SearchCache:
+    global SEEDERS_CACHE
+    if SEEDERS_CACHE is None:
+        SEEDERS_CACHE = SearchCache(os.path.join(__location__, 'seeders_cache.pickle'), ttl=SEEDERS_TTL,
+                                    negative_ttl=SEEDERS_NEGATIVE_TTL, max_entries=4096)
+    return SEEDERS_CACHE
+
+
+def extract_seeders(html_text: str) -> Optional[int]:
+    # None when the page isn't a torrent info page (threat defence, an error page or new markup)
+    global PEERS_XPATH
+    import lxml.html
+    from lxml import etree
+    if PEERS_XPATH is None:
+        PEERS_XPATH = etree.XPath('//tr[td[normalize-space()="Peers:"]]'
+                                  '/td[contains(concat(" ", @class, " "), " lista ")]')
+    try:
+        document = lxml.html.fromstring(html_text)
+    except etree.ParserError:
+        return None
+    for td in PEERS_XPATH(document):
+        seeders = SEEDERS_RE.search(td.text_content())
+        if seeders is not None:
+            return int(seeders.group(1))
+    return None
+
+
+def get_torrent_seeders(link: str, http_client, cookies: dict):
+    import requests
+    seeders_cache = get_seeders_cache()
+    seeders = seeders_cache.get(link)
+    if seeders is not None:
+        METRICS.inc('seeders_cache_hits')
+        return seeders
+    METRICS.inc('seeders_cache_misses')
+    try:
+        # Seeders change all the time, there is nothing to revalidate
+        get_torrent = http_client.get(link, cookies=cookies, use_cache=False)
+        get_torrent.raise_for_status()
+    except requests.RequestException as error:
+        LOGGER.info("Couldn't refresh seeds for {}: {}".format(link, error))
+        return None
+    seeders = extract_seeders(get_torrent.text)
+    if seeders is None:
+        LOGGER.info("No seeders on the page of {}".format(link))
+        return None
+    seeders_cache.put(link, seeders)
+    return seeders
+
+
+def get_torrents_seeds(torrent_options: list, workers: int = SEEDERS_WORKERS) -> list:
     if len(torrent_options) > 0:
-        new_torrent_options = []
-        for torrent in torrent_options:
-            LOGGER.info(torrent['title'])
-            get_torrent = requests.get(torrent['link'], cookies=rarbg_cookie)
-            soup_obj = bs4.BeautifulSoup(get_torrent.text, features="lxml")
-            table = soup_obj.select(
-                'body > table:nth-child(6) > tr > td:nth-child(2) > div > table > tr:nth-child(2) > td > div > table')
-            if table:
-                for tr in table[0].select('tr'):
-                    for td in tr.select('td', {'class': 'header2'}):
-                        if td.text.strip() == "Peers:":
-                            peers = tr.select('td.lista')[0].text.strip()
-                            seeders = re.search('Seeders : (\d*)', peers)
-                            torrent['seeders'] = seeders.group(1)
-            if 'seeders' not in torrent:
-                torrent['seeders'] = '0'
-            new_torrent_options.append(torrent)
-            LOGGER.info("Seeds: {}".format(torrent.get('seeders', -3)))
-        return new_torrent_options
+        # Like lxml and requests, only loaded when seeders are refreshed
+        from http_client import get_http_client
+        http_client = get_http_client()
+        rarbg_cookie = http_client.load_cookies(os.path.join(__location__, 'rarbg_cookie.json'))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            all_seeders = list(executor.map(lambda t: get_torrent_seeders(t.link, http_client, rarbg_cookie),
+                                            torrent_options))
+        refreshed = []
+        for torrent, seeders in zip(torrent_options, all_seeders):
+            # Keep the seeders from the search results when the page couldn't be fetched or read
+            if seeders is not None:
+                torrent = torrent._replace(seeders=seeders)
+            LOGGER.info("{}: {} seeds".format(torrent.title, torrent.seeders))
+            refreshed.append(torrent)
+        return refreshed
 
     return []
 
+
+def refresh_torrents_seeds(torrents: dict) -> dict:
+    # Every candidate of every episode goes through a single pool
+    refreshed = iter(get_torrents_seeds([torrent for torrent_options in torrents.values()
+                                         for torrent in torrent_options]))
+    get_seeders_cache().save()
+    return {ep_name: [next(refreshed) for torrent in torrent_options] for ep_name, torrent_options in torrents.items()}
+
+
 # We create another callback function to be called when an error is encountered
 
 
@@ -159,23 +295,53 @@ def on_connect_fail(result):
     LOGGER.info("result: {:}".format(result))
 
 
+def on_timeout(result, timeout):
+    LOGGER.info("Gave up waiting for the daemon after {} seconds".format(timeout))
+
+
+def _stop():
+    if reactor.running:
+        reactor.stop()
+
+
 def stop_reactor():
-    client.disconnect().addCallback(lambda ignore: reactor.stop())
-    LOGGER.info('Disconnecting from client')
     LOGGER.info('Stopping reactor')
+    if not client.connected():
+        # disconnect() never fires without a connection
+        _stop()
+        return
+    LOGGER.info('Disconnecting from client')
+    d = client.disconnect()
+    d.addTimeout(DISCONNECT_TIMEOUT, reactor)
+    d.addBoth(lambda ignore: _stop())
 
 
-if __name__ == '__main__':
+def main():
+    global STORE
     LOGGER.info('Starting Deluge Torrent Adder')
+    STORE = open_state_store(__location__)
     # Connect to a daemon running on the localhost
     # We get a Deferred object from this method and we use this to know if and when
     # the connection succeeded or failed.
-    d = client.connect()
+    d = connect()
     # We add the callback to the Deferred object we got from connect()
     d.addCallback(on_connect_success)
     # We add the callback (in this case it's an errback, for error)
     d.addErrback(on_connect_fail)
-    # Manually stop reactor after 5 seconds
-    reactor.callLater(30, stop_reactor)
+    # Cancel whatever is still pending if the daemon takes too long
+    d.addTimeout(ADD_TIMEOUT, reactor, onTimeoutCancel=on_timeout)
+    # Stop as soon as the last add has resolved (or the connection failed)
+    d.addBoth(lambda ignore: stop_reactor())
+    # Whatever hangs (the connection attempt itself or the teardown), cron must not pile up processes
+    reactor.callLater(ADD_TIMEOUT + DISCONNECT_TIMEOUT, _stop)
     # Run the twisted main loop to make everything go
-    reactor.run()
+    with profiled('adder'):
+        reactor.run()
+    STORE.close()
+    METRICS.write('adder')
+
+
+if __name__ == '__main__':
+    from log_config import configure_logging
+    configure_logging()
+    main()
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+HTTP_CACHE_DIR = os.path.join(__location__, 'http_cache')
+
+
+class HttpClient:
+
+    def __init__(self, cache_dir: str = HTTP_CACHE_DIR, pool_maxsize: int = 10, timeout: float = 30):
+        # One keep-alive pool per host, shared by every caller and thread
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._timeout = timeout
+        self._cache_dir = cache_dir
+        self._cookies = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    def load_cookies(self, file_name: str) -> dict:
+        # Cookie files are read once per client instead of on every request
+        with self._lock:
+            if file_name not in self._cookies:
+                with open(file_name) as cookie:
+                    self._cookies[file_name] = json.load(cookie)
+            return self._cookies[file_name]
+
+    def forget_cookies(self, file_name: str):
+        with self._lock:
+            self._cookies.pop(file_name, None)
+
+    def get(self, url: str, cookies: dict = None, use_cache: bool = True, **kwargs) -> requests.Response:
+        headers = dict(kwargs.pop('headers', None) or {})
+        cached = self._load_cache_entry(url) if use_cache and self._cache_dir else None
+        if cached is not None:
+            metadata = cached[0]
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        start = time.perf_counter()
+        response = self._session.get(url, cookies=cookies, headers=headers,
+                                     timeout=kwargs.pop('timeout', self._timeout), **kwargs)
+        latency = time.perf_counter() - start
+
+        response.from_cache = False
+        if cached is not None and response.status_code == 304:
+            response = self._build_cached_response(url, *cached)
+        elif use_cache and self._cache_dir and response.status_code == 200:
+            self._save_cache_entry(url, response)
+        self._record(url, latency, response.from_cache)
+        return response
+
+    def _record(self, url: str, latency: float, from_cache: bool):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            stats = self._stats.setdefault(host, {'requests': 0, 'latency': 0.0, 'max_latency': 0.0,
+                                                  'cache_hits': 0})
+            stats['requests'] += 1
+            stats['latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['cache_hits'] += 1 if from_cache else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {host: {'requests': s['requests'], 'cache_hits': s['cache_hits'],
+                           'avg_latency': s['latency'] / s['requests'], 'max_latency': s['max_latency']}
+                    for host, s in self._stats.items()}
+
+    def log_stats(self):
+        for host, stats in self.stats().items():
+            LOGGER.info('{}: {requests} requests, {cache_hits} not modified, avg {avg_latency:.3f}s, '
+                        'max {max_latency:.3f}s'.format(host, **stats))
+
+    def _cache_path(self, url: str) -> str:
+        return os.path.join(self._cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _load_cache_entry(self, url: str):
+        path = self._cache_path(url)
+        try:
+            with open(path + '.json') as metadata_in, open(path + '.body', 'rb') as body_in:
+                return json.load(metadata_in), body_in.read()
+        except (OSError, ValueError):
+            return None
+
+    def _save_cache_entry(self, url: str, response: requests.Response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            # Nothing to revalidate with, caching the body would never pay off
+            return
+        os.makedirs(self._cache_dir, exist_ok=True)
+        path = self._cache_path(url)
+        metadata = {'url': url, 'etag': etag, 'last_modified': last_modified, 'encoding': response.encoding,
+                    'headers': dict(response.headers)}
+        with open(path + '.body.tmp', 'wb') as body_out:
+            body_out.write(response.content)
+        with open(path + '.json.tmp', 'w') as metadata_out:
+            json.dump(metadata, metadata_out)
+        os.replace(path + '.body.tmp', path + '.body')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    @staticmethod
+    def _build_cached_response(url: str, metadata: dict, body: bytes) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = body
+        response.encoding = metadata.get('encoding')
+        response.headers = requests.structures.CaseInsensitiveDict(metadata.get('headers', {}))
+        response.from_cache = True
+        return response
+
+
+_DEFAULT_CLIENT = None
+_DEFAULT_CLIENT_LOCK = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    global _DEFAULT_CLIENT
+    with _DEFAULT_CLIENT_LOCK:
+        if _DEFAULT_CLIENT is None:
+            _DEFAULT_CLIENT = HttpClient()
+        return _DEFAULT_CLIENT
@@ -0,0 +1,370 @@
+import os
+import re
+import json
+import queue
+import time
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from info_hash import parse_info_hash
+from metrics import METRICS
+from rate_limiter import TokenBucket
+from records import SearchResult
+
+LOGGER = logging.getLogger(__name__)
+
+INDEXERS_FILE_NAME = 'indexers.json'
+
+TORZNAB_NAMESPACES = {'torznab': 'http://torznab.com/schemas/2015/feed'}
+# Built by parse_torznab, lxml is only loaded once a torznab indexer answers
+TORZNAB_ITEM_XPATH = None
+TORZNAB_PARSER = None
+NOT_ALPHANUMERIC_RE = re.compile(r'[^0-9a-z]+')
+
+
+class IndexerError(Exception):
+    pass
+
+
+class Indexer:
+    # A torrent search backend. IndexerPool gives up on a search after timeout seconds, and sends the same
+    # search a second time when the first one hasn't answered after hedge_after seconds.
+    TIMEOUT = 60.0
+    HEDGE_AFTER = None
+
+    def __init__(self, name: str, timeout: float = None, hedge_after: float = None, enabled: bool = True):
+        self.name = name
+        self.timeout = timeout or self.TIMEOUT
+        # 0 turns hedging off
+        self.hedge_after = self.HEDGE_AFTER if hedge_after is None else hedge_after or None
+        self.enabled = enabled
+
+    def search(self, search_string: str, retries: int = None) -> list:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.name)
+
+
+class RarbgIndexer(Indexer):
+    # torrentapi allows 1 request every 2 seconds
+    REQUESTS_PER_SECOND = 0.5
+    # Searches wait their turn at the rate limiter and empty answers are retried with a backoff
+    TIMEOUT = 300.0
+
+    def __init__(self, name: str = 'rarbg', retries: int = 3, requests_per_second: float = None,
+                 backoff: float = 1.0, max_backoff: float = 16.0, **kwargs):
+        super().__init__(name, **kwargs)
+        # Only loaded once something is searched, the calendar alone doesn't need it
+        import rarbgapi
+        self._client = rarbgapi.RarbgAPI(retries=retries)
+        self._retries = retries
+        self._rate_limiter = TokenBucket(rate=requests_per_second or self.REQUESTS_PER_SECOND)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    @staticmethod
+    def _categories() -> list:
+        import rarbgapi
+        return [rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES_UHD,
+                rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES_HD,
+                rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES]
+
+    def search(self, search_string: str, retries: int = None) -> list:
+        searchResults = []
+        searchRetries = 0
+
+        # torrentapi often answers a search with nothing the first time
+        while len(searchResults) == 0 and searchRetries < (retries or self._retries):
+            if searchRetries > 0:
+                METRICS.inc('indexer_retries', indexer=self.name)
+                time.sleep(min(self._backoff * 2 ** (searchRetries - 1), self._max_backoff))
+            # Every worker shares the same bucket, so the indexer never sees more than its budget
+            with METRICS.timer('rate_limit_wait'):
+                self._rate_limiter.acquire()
+            METRICS.inc('indexer_api_calls', indexer=self.name)
+            searchResults = self._client.search(
+                search_string=search_string, categories=self._categories(), extended_response=True)
+            searchRetries += 1
+
+        return [SearchResult(torrent.filename, torrent.download, torrent.page, int(torrent.size or 0),
+                             int(torrent.seeders or 0), self.name) for torrent in searchResults]
+
+
+class TorznabIndexer(Indexer):
+    # Jackett, Prowlarr and most trackers' own apis speak torznab. TV in SD, HD and UHD.
+    CATEGORIES = (5030, 5040, 5045)
+    TIMEOUT = 30.0
+    HEDGE_AFTER = 5.0
+
+    def __init__(self, name: str, url: str, api_key: str = None, categories=CATEGORIES, http_client=None,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+        self._url = url
+        self._api_key = api_key
+        self._categories = ','.join(str(category) for category in categories)
+        self._http_client = http_client
+
+    def search(self, search_string: str, retries: int = None) -> list:
+        # A single attempt, an empty answer is a real answer here and slow ones get hedged
+        import requests
+        from http_client import get_http_client
+        params = {'t': 'search', 'q': search_string, 'cat': self._categories, 'extended': 1}
+        if self._api_key:
+            params['apikey'] = self._api_key
+        METRICS.inc('indexer_api_calls', indexer=self.name)
+        try:
+            response = (self._http_client or get_http_client()).get(self._url, params=params, use_cache=False,
+                                                                    timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            # The request url carries the api key, it is kept out of the logs
+            message = str(error).replace(self._api_key, '***') if self._api_key else str(error)
+            raise IndexerError('{}: {}'.format(self.name, message)) from None
+        return parse_torznab(response.content, self.name)
+
+
+def parse_torznab(content: bytes, indexer: str) -> list:
+    global TORZNAB_ITEM_XPATH, TORZNAB_PARSER
+    from lxml import etree
+    if TORZNAB_PARSER is None:
+        TORZNAB_ITEM_XPATH = etree.XPath('/rss/channel/item')
+        # Never resolve entities or fetch anything an indexer response points at
+        TORZNAB_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+    document = etree.fromstring(content, TORZNAB_PARSER)
+    if document.tag == 'error':
+        raise IndexerError('{}: error {}, {}'.format(indexer, document.get('code'), document.get('description')))
+
+    results = []
+    for item in TORZNAB_ITEM_XPATH(document):
+        attributes = {attribute.get('name'): attribute.get('value')
+                      for attribute in item.iterfind('torznab:attr', TORZNAB_NAMESPACES)}
+        title = item.findtext('title')
+        enclosure = item.find('enclosure')
+        urls = [attributes.get('magneturl'), item.findtext('link'), None if enclosure is None else enclosure.get('url')]
+        magnet = next((url for url in urls if url and url.startswith('magnet:')), None)
+        if magnet is None and attributes.get('infohash'):
+            magnet = 'magnet:?xt=urn:btih:{}&dn={}'.format(attributes['infohash'], urllib.parse.quote(title or ''))
+        if not title or magnet is None:
+            # Deluge is only handed magnets, .torrent downloads are left out
+            continue
+        results.append(SearchResult(title, magnet, item.findtext('comments'),
+                                    int(attributes.get('size') or item.findtext('size') or 0),
+                                    int(attributes.get('seeders') or 0), indexer))
+    return results
+
+
+def _normalise(text: str) -> str:
+    return NOT_ALPHANUMERIC_RE.sub(' ', text.casefold())
+
+
+class LocalFileIndexer(Indexer):
+    # Releases listed in a json file, [{"title", "magnet", "link", "size", "seeders"}, ...], read again
+    # whenever it changes. A release matches when every word searched for is in its title.
+    TIMEOUT = 5.0
+
+    def __init__(self, name: str = 'local', path: str = 'releases.json', **kwargs):
+        super().__init__(name, **kwargs)
+        self._path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        # (normalised title, SearchResult)
+        self._releases = []
+
+    def _load(self) -> list:
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self._path) as releases_in:
+                    releases = json.load(releases_in)
+                self._releases = [(_normalise(release['title']),
+                                   SearchResult(release['title'], release['magnet'], release.get('link'),
+                                                int(release.get('size') or 0), int(release.get('seeders') or 0),
+                                                self.name))
+                                  for release in releases]
+                self._mtime = mtime
+            return self._releases
+
+    def search(self, search_string: str, retries: int = None) -> list:
+        words = _normalise(search_string).split()
+        return [result for title, result in self._load() if all(word in title for word in words)]
+
+
+def merge_results(result_lists) -> list:
+    # Deduplicated by info hash (by magnet when it has none) in first seen order, keeping the most seeded copy
+    merged = {}
+    for results in result_lists:
+        for result in results:
+            key = parse_info_hash(result.magnet) or result.magnet
+            kept = merged.get(key)
+            if kept is None:
+                merged[key] = result
+            else:
+                METRICS.inc('indexer_duplicates')
+                if result.seeders > kept.seeders:
+                    merged[key] = result
+    return list(merged.values())
+
+
+class DaemonThreadPool:
+    # The part of ThreadPoolExecutor IndexerPool uses, on daemon threads. The interpreter joins every
+    # ThreadPoolExecutor thread at exit, even after shutdown(wait=False), so a search still stuck on an
+    # indexer would keep the process from exiting.
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._queue.put((future, fn, args, kwargs))
+            # Threads are started on demand, only when none is idle
+            if not self._idle.acquire(blocking=False) and len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name='{}_{}'.format(self._thread_name_prefix, len(self._threads)))
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as error:
+                    future.set_exception(error)
+            self._idle.release()
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        item[0].cancel()
+            for thread in self._threads:
+                self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class IndexerPool:
+    # Fans every search out to the enabled indexers in parallel and merges what they answer, in the order
+    # the indexers are listed so the results don't depend on which one was faster. An indexer that fails or
+    # is still searching after its timeout is left out of that search.
+
+    def __init__(self, indexers: list, max_workers: int = 8):
+        self._indexers = [indexer for indexer in indexers if indexer.enabled]
+        if not self._indexers:
+            raise ValueError('No indexer enabled')
+        # max_workers threads per indexer. An abandoned search keeps its thread until its indexer gives up,
+        # in a pool of its own it only holds up later searches of that same indexer.
+        self._executors = {indexer: DaemonThreadPool(max_workers=max_workers,
+                                                     thread_name_prefix='indexer-{}'.format(indexer.name))
+                           for indexer in self._indexers}
+
+    @property
+    def names(self) -> tuple:
+        return tuple(indexer.name for indexer in self._indexers)
+
+    def close(self):
+        # Queued searches are cancelled, running ones are left to finish or give up on their daemon threads
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, indexer: Indexer, search_string: str, retries: int):
+        def search():
+            with METRICS.timer('indexer_backend_search', indexer=indexer.name):
+                return indexer.search(search_string, retries)
+        return self._executors[indexer].submit(search)
+
+    def search(self, search_string: str, retries: int = None) -> tuple:
+        # (merged results, True when every indexer answered)
+        start = time.monotonic()
+        attempts = {indexer: [self._submit(indexer, search_string, retries)] for indexer in self._indexers}
+        answers = {}
+        while len(answers) < len(attempts):
+            elapsed = time.monotonic() - start
+            wake_up = []
+            for indexer, futures in attempts.items():
+                if indexer in answers:
+                    continue
+                done = [future for future in futures if future.done()]
+                answer = next((future.result() for future in done if future.exception() is None), None)
+                if answer is not None:
+                    answers[indexer] = answer
+                elif len(done) == len(futures):
+                    LOGGER.warning('{} failed searching {!r}: {}'.format(indexer.name, search_string,
+                                                                         done[-1].exception()))
+                    METRICS.inc('indexer_errors', indexer=indexer.name)
+                    answers[indexer] = None
+                elif elapsed >= indexer.timeout:
+                    LOGGER.warning('{} gave no answer for {!r} in {:g}s'.format(indexer.name, search_string,
+                                                                                  indexer.timeout))
+                    METRICS.inc('indexer_timeouts', indexer=indexer.name)
+                    answers[indexer] = None
+                else:
+                    # Hedged request: the tail of a slow backend is often a single slow request
+                    if indexer.hedge_after is not None and len(futures) == 1:
+                        if elapsed >= indexer.hedge_after:
+                            METRICS.inc('indexer_hedged_requests', indexer=indexer.name)
+                            futures.append(self._submit(indexer, search_string, retries))
+                        else:
+                            wake_up.append(indexer.hedge_after)
+                    wake_up.append(indexer.timeout)
+            # Requests that lost the race or were given up on leave the queue if they haven't started yet
+            for indexer in answers:
+                for future in attempts[indexer]:
+                    future.cancel()
+            pending = [future for indexer, futures in attempts.items() if indexer not in answers
+                       for future in futures if not future.done()]
+            if pending:
+                wait(pending, timeout=max(0.0, min(wake_up) - (time.monotonic() - start)),
+                     return_when=FIRST_COMPLETED)
+
+        results = [answers[indexer] for indexer in self._indexers]
+        return merge_results(answer for answer in results if answer is not None), None not in results
+
+
+INDEXER_TYPES = {'rarbg': RarbgIndexer, 'torznab': TorznabIndexer, 'local': LocalFileIndexer}
+
+
+def load_indexers(file_name: str) -> list:
+    # [{"type": "rarbg" | "torznab" | "local", "name": ..., "enabled": ..., "timeout": ..., "hedge_after": ...,
+    # and the options of the type}, ...], None without a file
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name) as config_in:
+        config = json.load(config_in)
+    indexers = []
+    for options in config:
+        options = dict(options)
+        indexer_type = INDEXER_TYPES[options.pop('type')]
+        if indexer_type is LocalFileIndexer and 'path' in options:
+            # Relative to the configuration file
+            options['path'] = os.path.join(os.path.dirname(file_name), options['path'])
+        indexers.append(indexer_type(**options))
+    LOGGER.info('Indexers: {}'.format(', '.join(indexer.name for indexer in indexers if indexer.enabled)))
+    return indexers
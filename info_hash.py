@@ -0,0 +1,22 @@
+import re
+import base64
+import binascii
+from typing import Optional
+
+BTIH_RE = re.compile(r'[?&]xt=urn:btih:([0-9a-z]+)', re.IGNORECASE)
+
+
+def parse_info_hash(magnet: str) -> Optional[str]:
+    # Lower case hex info hash of a magnet link, its xt may be in hex (40) or base32 (32 characters)
+    match = BTIH_RE.search(magnet or '')
+    if match is None:
+        return None
+    value = match.group(1)
+    try:
+        if len(value) == 40:
+            return binascii.unhexlify(value).hex()
+        if len(value) == 32:
+            return base64.b32decode(value.upper()).hex()
+    except (binascii.Error, ValueError):
+        pass
+    return None
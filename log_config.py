@@ -0,0 +1,44 @@
+# Logging of the entry points: the console and a file rotated every midnight
+import os
+import logging.config
+
+LOG_FILE = os.environ.get('AUTO_TORRENT_LOG_FILE', '/var/log/auto_torrent/auto_torrent.log')
+
+
+def get_logging_config(log_file: str = LOG_FILE, level: str = 'INFO') -> dict:
+    handlers = {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default',
+            'level': 'DEBUG',
+        },
+    }
+    if log_file:
+        handlers['file'] = {
+            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'filename': log_file,
+            'formatter': 'default',
+            'when': 'midnight',
+            'backupCount': 10,
+            'level': 'DEBUG'
+        }
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'default': {
+                'format': '%(asctime)s: %(module)22s->%(funcName)-26s - [%(levelname)5s] - %(message)s',
+                'datefmt': '[%d-%m-%Y | %H:%M:%S]'
+            }
+        },
+        'handlers': handlers,
+        'root': {
+            'handlers': list(handlers),
+            'level': level,
+        },
+    }
+
+
+def configure_logging(log_file: str = LOG_FILE, level: str = 'INFO'):
+    # Only entry points call this, importing a module never touches the log file
+    logging.config.dictConfig(get_logging_config(log_file, level))
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import functools
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+# Point this at the node_exporter textfile collector directory to have the metrics scraped
+METRICS_DIR = os.environ.get('AUTO_TORRENT_METRICS_DIR', os.path.join(__location__, 'metrics'))
+# cprofile or pyinstrument, profiles the run when set
+PROFILER = os.environ.get('AUTO_TORRENT_PROFILE')
+
+PREFIX = 'autotorrent_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+# Samples kept per histogram for the percentiles in the run summary
+MAX_SAMPLES = 10000
+
+
+class Histogram:
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def percentile(self, fraction: float) -> float:
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] if samples else 0.0
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._started = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        # Decorator version of timer
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._started = time.time()
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, labels in values}):
+                    suffix = '_total' if kind == 'counter' else ''
+                    lines.append('# TYPE {}{}{} {}'.format(PREFIX, name, suffix, kind))
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append('{}{}{}{} {}'.format(PREFIX, name, suffix, self._format_labels(labels), value))
+            for name in sorted({name for name, labels in self._histograms}):
+                lines.append('# TYPE {}{}_seconds histogram'.format(PREFIX, name))
+                for (metric, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.bucket_counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}{}_seconds_bucket{} {}'.format(
+                            PREFIX, name, self._format_labels(labels, (('le', le),)), cumulative))
+                    lines.append('{}{}_seconds_sum{} {}'.format(PREFIX, name, self._format_labels(labels),
+                                                                histogram.sum))
+                    lines.append('{}{}_seconds_count{} {}'.format(PREFIX, name, self._format_labels(labels),
+                                                                  histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        def label(name, labels):
+            return name + self._format_labels(labels)
+
+        with self._lock:
+            return {
+                'started': self._started,
+                'duration': time.time() - self._started,
+                'counters': {label(*key): value for key, value in sorted(self._counters.items())},
+                'gauges': {label(*key): value for key, value in sorted(self._gauges.items())},
+                'stages': {label(*key): {'count': h.count, 'total': h.sum, 'p50': h.percentile(0.5),
+                                         'p95': h.percentile(0.95), 'max': max(h.samples, default=0.0)}
+                           for key, h in sorted(self._histograms.items(), key=lambda item: item[0])},
+            }
+
+    def write(self, job: str, directory: str = METRICS_DIR):
+        # <job>.prom for the textfile collector and <job>.json as a summary of the run
+        os.makedirs(directory, exist_ok=True)
+        self.set('last_run_timestamp_seconds', time.time(), job=job)
+        for file_name, content in ((job + '.prom', self.to_prometheus()),
+                                   (job + '.json', json.dumps(self.summary(), indent=2))):
+            path = os.path.join(directory, file_name)
+            # The collector may read at any moment, so the file is replaced rather than rewritten
+            with open(path + '.tmp', 'w') as metrics_out:
+                metrics_out.write(content)
+            os.replace(path + '.tmp', path)
+        LOGGER.info('Metrics written to {}'.format(directory))
+
+
+METRICS = Metrics()
+
+
+@contextlib.contextmanager
+def profiled(job: str, profiler: str = PROFILER, directory: str = METRICS_DIR):
+    if not profiler:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    if profiler == 'pyinstrument':
+        import pyinstrument
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(os.path.join(directory, job + '.html'), 'w') as profile_out:
+                profile_out.write(profile.output_html())
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(directory, job + '.prof'))
+    LOGGER.info('{} profile written to {}'.format(profiler, directory))
@@ -0,0 +1,150 @@
+import queue
+import logging
+import threading
+
+from metrics import METRICS
+from query_planner import plan_episode_queries
+from retry_scheduler import schedule_releases
+from torrent_ranker import TorrentRanker
+
+LOGGER = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+
+    def __init__(self, name: str, fn, workers: int = 1, queue_size: int = 16):
+        # fn(item) returns an iterable of the items passed on to the next stage (empty to drop the item)
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class Pipeline:
+    # Each stage reads from its own bounded queue with its own worker threads. A full queue blocks the
+    # stage in front of it, so a slow stage throttles everything upstream instead of piling up items.
+
+    def __init__(self, stages: list):
+        self._stages = stages
+        self.stats = {stage.name: {'in': 0, 'out': 0, 'errors': 0} for stage in stages}
+        self._lock = threading.Lock()
+
+    def run(self, source):
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self._stages] + [None]
+        remaining = [stage.workers for stage in self._stages]
+        threads = []
+        for index, stage in enumerate(self._stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index, queues, remaining),
+                                          name='{}-{}'.format(stage.name, worker), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for item in source:
+            queues[0].put(item)
+        for worker in range(self._stages[0].workers):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        return self.stats
+
+    def _work(self, index: int, queues: list, remaining: list):
+        stage = self._stages[index]
+        stats = self.stats[stage.name]
+        in_queue, out_queue = queues[index], queues[index + 1]
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            try:
+                with METRICS.timer('pipeline_stage', stage=stage.name):
+                    outputs = list(stage.fn(item) or ())
+            except Exception:
+                LOGGER.exception('Stage {} failed'.format(stage.name))
+                METRICS.inc('stage_errors', stage=stage.name)
+                with self._lock:
+                    stats['errors'] += 1
+                continue
+            with self._lock:
+                stats['in'] += 1
+                stats['out'] += len(outputs)
+            METRICS.inc('stage_items', stage=stage.name)
+            if out_queue is not None:
+                for output in outputs:
+                    out_queue.put(output)
+
+        # The last worker of a stage to finish tells every worker of the next one to stop
+        with self._lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and out_queue is not None:
+            for worker in range(self._stages[index + 1].workers):
+                out_queue.put(_DONE)
+
+
+def stream_releases(rarbg_client, store, today_releases: list, add=None, ranker: TorrentRanker = None,
+                    add_workers: int = 4, queue_size: int = 16) -> list:
+    # Streaming counterpart of torrent_list_generator.search_releases:
+    #   calendar -> series queries -> provider filter -> search -> parse -> rank -> add
+    # An episode is saved, ranked and handed to add(torrent) as soon as its series' search is done.
+    # Returns the episodes still waiting: every episode not known to be finished, so one whose stage
+    # failed is searched again later instead of being dropped.
+    scheduler, due_releases = schedule_releases(store, today_releases)
+    LOGGER.info('Streaming {} of {} episodes'.format(len(due_releases), len(scheduler)))
+
+    ranker = ranker or TorrentRanker()
+    finished = []
+
+    def provider_filter(query):
+        # Episodes already found or not wanted are dropped, the series query goes on if any are left
+        for ep_name, episode in list(query.episodes.items()):
+            if not rarbg_client.is_wanted(episode) or ep_name in store.torrents:
+                del query.episodes[ep_name]
+                finished.append(episode)
+        if query.episodes:
+            yield query
+
+    def search(query):
+        results = rarbg_client.search_series(query)
+        for ep_name, episode in query.episodes.items():
+            if results[ep_name] is None:
+                # Covered by a season pack
+                finished.append(episode)
+            else:
+                yield ep_name, episode, results[ep_name]
+
+    def parse(item):
+        ep_name, episode, results = item
+        ep_torrents = rarbg_client.parse_search_results(results)
+        if not ep_torrents:
+            LOGGER.info('Added to waiting list: {:s} {:s}'.format(episode.name, episode.number))
+            return
+        store.torrents[ep_name] = ep_torrents
+        finished.append(episode)
+        yield ep_name, ep_torrents
+
+    def rank(item):
+        ep_name, ep_torrents = item
+        best = ranker.best(ep_torrents)
+        yield {'title': best.title, 'magnet': best.magnet, 'ep_name': ep_name}
+
+    stages = [Stage('filter', provider_filter, queue_size=queue_size),
+              Stage('search', search, workers=rarbg_client.workers, queue_size=queue_size),
+              Stage('parse', parse, queue_size=queue_size)]
+    if add is not None:
+        stages += [Stage('rank', rank, queue_size=queue_size),
+                   Stage('add', add, workers=add_workers, queue_size=queue_size)]
+
+    # Episodes of the same series and season share their searches
+    queries = plan_episode_queries(due_releases)
+    METRICS.inc('series_queries', len(queries))
+    stats = Pipeline(stages).run(queries)
+    LOGGER.info('Pipeline: {}'.format(', '.join('{} {in}/{out}/{errors}'.format(name, **s)
+                                                for name, s in stats.items())))
+
+    waiting_list = scheduler.record_results(due_releases, finished)
+    scheduler.save()
+    return waiting_list
@@ -0,0 +1,36 @@
+from collections import OrderedDict
+
+from torrent_title_parser import get_episode_name, get_season_number
+
+
+class SeriesQuery:
+    # One season search for every episode of a series and season in the run
+
+    def __init__(self, series_name: str, season_number: str):
+        self.series_name = series_name
+        self.season_number = season_number
+        # ep_name -> episode, in the order they were planned
+        self.episodes = OrderedDict()
+
+    @property
+    def search_string(self) -> str:
+        return self.series_name + " " + self.season_number
+
+    def __repr__(self):
+        return 'SeriesQuery({!r}, {} episodes)'.format(self.search_string, len(self.episodes))
+
+
+def plan_series_queries(episodes) -> list:
+    # Groups (ep_name, episode) pairs by series and season, repeated episodes are only planned once
+    queries = OrderedDict()
+    for ep_name, episode in episodes:
+        key = (episode.name.casefold(), get_season_number(episode.number).casefold())
+        query = queries.get(key)
+        if query is None:
+            query = queries[key] = SeriesQuery(episode.name, get_season_number(episode.number))
+        query.episodes.setdefault(ep_name, episode)
+    return list(queries.values())
+
+
+def plan_episode_queries(episodes: list) -> list:
+    return plan_series_queries((get_episode_name(episode), episode) for episode in episodes)
@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        # rate is in tokens per second, capacity is the maximum burst size
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens +
+                           (now - self._last_time) * self._rate)
+        self._last_time = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0):
+        # Blocks until the tokens are available. The lock is released while sleeping, so
+        # waiting threads are served roughly in the order the bucket refills.
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            time.sleep(wait)
@@ -0,0 +1,108 @@
+import sys
+import enum
+from typing import NamedTuple
+
+# Sizes used to be stored in MiB
+MIB = 1024 * 1024
+
+
+class Quality(enum.IntEnum):
+    STANDARD = 0
+    HD_720P = 1
+    HD_1080P = 2
+
+    @property
+    def label(self) -> str:
+        return _QUALITY_LABELS[self]
+
+    @classmethod
+    def from_label(cls, label) -> 'Quality':
+        # Labels as TorrentTitleParser returns them ('1080p', 'Standard'), anything else is STANDARD
+        if isinstance(label, cls):
+            return label
+        return _QUALITIES.get((label or '').casefold(), cls.STANDARD)
+
+
+_QUALITY_LABELS = {Quality.STANDARD: 'Standard', Quality.HD_720P: '720p', Quality.HD_1080P: '1080p'}
+_QUALITIES = {label.casefold(): quality for quality, label in _QUALITY_LABELS.items()}
+
+
+class RipType(enum.IntEnum):
+    UNDEFINED = 0
+    HDTV = 1
+    WEB = 2
+
+    @property
+    def label(self) -> str:
+        return _RIP_TYPE_LABELS[self]
+
+    @classmethod
+    def from_label(cls, label) -> 'RipType':
+        # Every WEB flavour (WEB-DL, WEBRip, ...) is a WEB release
+        if isinstance(label, cls):
+            return label
+        label = (label or '').casefold()
+        return cls.WEB if 'web' in label else cls.HDTV if 'hdtv' in label else cls.UNDEFINED
+
+
+_RIP_TYPE_LABELS = {RipType.UNDEFINED: 'Undefined', RipType.HDTV: 'HDTV', RipType.WEB: 'WEB'}
+
+
+class Episode(NamedTuple):
+    name: str
+    number: str
+    provider: str = ''
+    series_ref: str = ''
+    first_ep: bool = False
+    last_ep: bool = False
+
+    @classmethod
+    def create(cls, name: str, number: str, provider: str = '', series_ref: str = '', first_ep: bool = False,
+               last_ep: bool = False) -> 'Episode':
+        # Series names and providers repeat across a whole calendar, each is kept once
+        return cls(sys.intern(name), number, sys.intern(provider), series_ref, first_ep, last_ep)
+
+    @classmethod
+    def from_json(cls, value) -> 'Episode':
+        # The compact list form, or the dict episodes were stored as before
+        if isinstance(value, dict):
+            return cls.create(value['name'], value['number'], value.get('provider', ''),
+                              value.get('series_ref', ''), value.get('first_ep', False), value.get('last_ep', False))
+        return cls.create(*value)
+
+    def to_json(self) -> list:
+        return list(self)
+
+
+class TorrentCandidate(NamedTuple):
+    title: str
+    magnet: str
+    link: str = None
+    rip_type: RipType = RipType.UNDEFINED
+    quality: Quality = Quality.STANDARD
+    # Bytes
+    size: int = 0
+    seeders: int = 0
+
+    @classmethod
+    def from_row(cls, row) -> 'TorrentCandidate':
+        # A state store row, or a torrent dict from the pickles (size in MiB there)
+        row = dict(row)
+        size = row['size_bytes'] if 'size_bytes' in row else (row.get('size') or 0) * MIB
+        return cls(row['title'], row['magnet'], row.get('link'), RipType.from_label(row.get('rip_type')),
+                   Quality.from_label(row.get('quality')), int(size or 0), int(row.get('seeders') or 0))
+
+    def to_row(self) -> tuple:
+        # In state_store.TORRENT_COLUMNS order
+        return self.title, self.link, self.rip_type.label, self.quality.label, self.size, self.magnet, self.seeders
+
+
+class SearchResult(NamedTuple):
+    # A release as an indexer returned it, before it is matched to an episode
+    title: str
+    magnet: str
+    link: str = None
+    # Bytes
+    size: int = 0
+    seeders: int = 0
+    indexer: str = ''
@@ -0,0 +1,119 @@
+import time
+import heapq
+import logging
+import datetime
+
+from torrent_title_parser import get_episode_name
+
+LOGGER = logging.getLogger(__name__)
+
+BASE_DELAY = 30 * 60
+MAX_DELAY = 24 * 60 * 60
+MAX_AGE = 14 * 24 * 60 * 60
+
+
+class RetryScheduler:
+    # Waiting episodes ordered by their next attempt. Each failed search doubles the delay before the
+    # next one (up to max_delay) and episodes still missing after max_age are dropped.
+
+    def __init__(self, store, base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY,
+                 max_age: float = MAX_AGE, clock=time.time):
+        self._store = store
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_age = max_age
+        self._clock = clock
+        self._entries = {entry['ep_name']: entry for entry in store.get_waiting_entries()}
+        # (next_attempt, ep_name), stale items are skipped when popped
+        self._heap = [(entry['next_attempt'], ep_name) for ep_name, entry in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ep_name):
+        return ep_name in self._entries
+
+    def _schedule(self, entry: dict, next_attempt: float):
+        entry['next_attempt'] = next_attempt
+        heapq.heappush(self._heap, (next_attempt, entry['ep_name']))
+
+    def _today(self) -> datetime.date:
+        return datetime.date.fromtimestamp(self._clock())
+
+    def add(self, episode, seen_on: datetime.date = None):
+        # An episode the calendar reports (seen_on, today by default) that is already waiting is searched
+        # right away with its backoff reset, the first time it is seen after its last attempt. Seeing it
+        # again the same day changes nothing.
+        now = self._clock()
+        ep_name = get_episode_name(episode)
+        entry = self._entries.get(ep_name)
+        if entry is None:
+            self._entries[ep_name] = entry = {'ep_name': ep_name, 'episode': episode, 'attempts': 0,
+                                              'added_at': now, 'last_attempt': 0.0, 'next_attempt': now}
+            heapq.heappush(self._heap, (now, ep_name))
+        elif entry['next_attempt'] < float('inf') and \
+                entry['last_attempt'] < time.mktime((seen_on or self._today()).timetuple()):
+            LOGGER.info('{} is on the calendar again, searching it with a fresh backoff'.format(ep_name))
+            entry['attempts'] = 0
+            if entry['next_attempt'] > now:
+                self._schedule(entry, now)
+
+    def evict_expired(self) -> list:
+        now = self._clock()
+        expired = [ep_name for ep_name, entry in self._entries.items() if now - entry['added_at'] > self._max_age]
+        for ep_name in expired:
+            LOGGER.info('Giving up on {} after {} attempts'.format(ep_name, self._entries[ep_name]['attempts']))
+            del self._entries[ep_name]
+        return expired
+
+    def pop_due(self) -> list:
+        now = self._clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_attempt, ep_name = heapq.heappop(self._heap)
+            entry = self._entries.get(ep_name)
+            if entry is None or entry['next_attempt'] != next_attempt:
+                continue
+            entry['next_attempt'] = float('inf')
+            due.append(entry['episode'])
+        return due
+
+    def record_results(self, searched: list, finished: list) -> list:
+        # Only the episodes known to be finished (found, covered by a season pack or not wanted) are done
+        # with. Everything else searched backs off, including episodes whose search or parse failed.
+        # Returns the episodes still waiting.
+        now = self._clock()
+        finished = {get_episode_name(episode) for episode in finished}
+        waiting_list = []
+        for episode in searched:
+            ep_name = get_episode_name(episode)
+            entry = self._entries.get(ep_name)
+            if entry is None:
+                continue
+            if ep_name in finished:
+                del self._entries[ep_name]
+                continue
+            entry['attempts'] += 1
+            entry['last_attempt'] = now
+            delay = min(self._base_delay * 2 ** (entry['attempts'] - 1), self._max_delay)
+            self._schedule(entry, now + delay)
+            waiting_list.append(episode)
+            LOGGER.info('Next search for {} in {:.0f} minutes'.format(ep_name, delay / 60))
+        return waiting_list
+
+    def save(self):
+        # Episodes popped but never recorded (e.g. the search crashed) are due again on the next run
+        now = self._clock()
+        self._store.save_waiting_entries([dict(entry, next_attempt=now) if entry['next_attempt'] == float('inf')
+                                          else entry for entry in self._entries.values()])
+
+
+def schedule_releases(store, releases: list) -> tuple:
+    # (scheduler, episodes to search now): the calendar's releases join the waiting episodes and only the
+    # ones that are due get searched, episodes waiting for too long are dropped first
+    scheduler = RetryScheduler(store)
+    scheduler.evict_expired()
+    for episode in releases:
+        scheduler.add(episode)
+    return scheduler, scheduler.pop_due()
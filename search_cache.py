@@ -0,0 +1,92 @@
+import os
+import time
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SearchCache:
+
+    def __init__(self, file_name: str = None, ttl: float = 3 * 60 * 60, negative_ttl: float = 20 * 60,
+                 max_entries: int = 2048):
+        self._file_name = file_name
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), kept in least to most recently used order
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if self._file_name is None or not os.path.isfile(self._file_name):
+            return
+        try:
+            with open(self._file_name, "rb") as pickle_in:
+                entries = pickle.load(pickle_in)
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            LOGGER.warning('Ignoring unreadable search cache {}: {}'.format(self._file_name, error))
+            return
+        now = time.time()
+        with self._lock:
+            self._entries = OrderedDict((k, v) for k, v in entries.items() if v[0] > now)
+
+    def save(self):
+        if self._file_name is None:
+            return
+        with self._lock:
+            self._evict_expired()
+            entries = self._entries.copy()
+        # Write to a temporary file first so a crash never leaves a truncated cache behind
+        tmp_file_name = self._file_name + '.tmp'
+        with open(tmp_file_name, "wb") as pickle_out:
+            pickle.dump(entries, pickle_out)
+        os.replace(tmp_file_name, self._file_name)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl: float = None):
+        if ttl is None:
+            # Empty results are only trusted for a short while, the release may show up any moment
+            ttl = self._ttl if value else self._negative_ttl
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict_expired(self):
+        now = time.time()
+        for key in [k for k, v in self._entries.items() if v[0] <= now]:
+            del self._entries[key]
+
+    def __contains__(self, key) -> bool:
+        # A plain look, neither counted as a hit or miss nor making the entry recently used
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
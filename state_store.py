@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+import contextlib
+from collections.abc import MutableMapping
+
+from records import Episode, TorrentCandidate
+from torrent_title_parser import get_episode_name
+
+LOGGER = logging.getLogger(__name__)
+
+STATE_FILE_NAME = 'auto_torrent.sqlite'
+LEGACY_TORRENTS_FILE_NAME = 'torrents.pickle'
+LEGACY_WAITING_FILE_NAME = 'waiting_torrents.pickle'
+
+TORRENT_COLUMNS = ('title', 'link', 'rip_type', 'quality', 'size_bytes', 'magnet', 'seeders')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS episodes (
+    ep_name     TEXT PRIMARY KEY,
+    added       INTEGER NOT NULL DEFAULT 0,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS episodes_added ON episodes (added);
+
+CREATE TABLE IF NOT EXISTS torrents (
+    id          INTEGER PRIMARY KEY,
+    ep_name     TEXT NOT NULL REFERENCES episodes (ep_name) ON DELETE CASCADE,
+    title       TEXT NOT NULL,
+    link        TEXT,
+    rip_type    TEXT,
+    quality     TEXT,
+    size_bytes  INTEGER,
+    magnet      TEXT NOT NULL,
+    seeders     INTEGER,
+    UNIQUE (ep_name, magnet)
+);
+
+CREATE TABLE IF NOT EXISTS waiting (
+    ep_name       TEXT PRIMARY KEY,
+    episode       TEXT NOT NULL,
+    added_at      REAL NOT NULL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    last_attempt  REAL NOT NULL DEFAULT 0,
+    next_attempt  REAL NOT NULL DEFAULT 0
+);
+'''
+
+# Columns added after a table was first created: table -> [(column, definition, statement filling it in)]
+MIGRATIONS = {
+    'waiting': [('attempts', 'INTEGER NOT NULL DEFAULT 0', None),
+                ('last_attempt', 'REAL NOT NULL DEFAULT 0', None),
+                ('next_attempt', 'REAL NOT NULL DEFAULT 0', None)],
+    # Sizes were stored in MiB as REAL
+    'torrents': [('size_bytes', 'INTEGER', 'UPDATE torrents SET size_bytes = CAST(size * 1048576 AS INTEGER)')],
+}
+WAITING_COLUMNS = ('ep_name', 'episode', 'added_at', 'attempts', 'last_attempt', 'next_attempt')
+
+
+class EpisodeTorrents(MutableMapping):
+    # dict-like view of the torrents table (ep_name -> list of TorrentCandidate), so code written against
+    # the old pickled dict keeps working while every access is an indexed lookup
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, ep_name: str) -> list:
+        with self._store.transaction() as connection:
+            if connection.execute('SELECT 1 FROM episodes WHERE ep_name = ?', (ep_name,)).fetchone() is None:
+                raise KeyError(ep_name)
+            rows = connection.execute('SELECT {} FROM torrents WHERE ep_name = ? ORDER BY id'.format(
+                ', '.join(TORRENT_COLUMNS)), (ep_name,)).fetchall()
+        return [TorrentCandidate.from_row(row) for row in rows]
+
+    def __setitem__(self, ep_name: str, torrents: list):
+        with self._store.transaction() as connection:
+            self._store.upsert_episode(connection, ep_name, torrents)
+
+    def __delitem__(self, ep_name: str):
+        with self._store.transaction() as connection:
+            if connection.execute('DELETE FROM episodes WHERE ep_name = ?', (ep_name,)).rowcount == 0:
+                raise KeyError(ep_name)
+
+    def __contains__(self, ep_name) -> bool:
+        with self._store.transaction() as connection:
+            return connection.execute('SELECT 1 FROM episodes WHERE ep_name = ?', (ep_name,)).fetchone() is not None
+
+    def __iter__(self):
+        with self._store.transaction() as connection:
+            ep_names = [row[0] for row in connection.execute('SELECT ep_name FROM episodes ORDER BY ep_name')]
+        return iter(ep_names)
+
+    def __len__(self) -> int:
+        with self._store.transaction() as connection:
+            return connection.execute('SELECT COUNT(*) FROM episodes').fetchone()[0]
+
+
+class StateStore:
+
+    def __init__(self, file_name: str):
+        self._file_name = file_name
+        # One connection shared by every thread, serialised by the lock
+        self._connection = sqlite3.connect(file_name, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        self.torrents = EpisodeTorrents(self)
+
+    def _migrate(self):
+        with self.transaction() as connection:
+            for table, columns in MIGRATIONS.items():
+                existing = {row['name'] for row in connection.execute('PRAGMA table_info({})'.format(table))}
+                for column, definition, fill in columns:
+                    if column not in existing:
+                        connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition))
+                        if fill is not None:
+                            connection.execute(fill)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Commits on success and rolls back if anything inside raises
+        with self._lock, self._connection:
+            yield self._connection
+
+    @staticmethod
+    def upsert_episode(connection, ep_name: str, torrents: list):
+        connection.execute('INSERT INTO episodes (ep_name, updated_at) VALUES (?, ?) '
+                           'ON CONFLICT (ep_name) DO UPDATE SET updated_at = excluded.updated_at',
+                           (ep_name, time.time()))
+        connection.executemany(
+            'INSERT INTO torrents (ep_name, {0}) VALUES (?, {1}) ON CONFLICT (ep_name, magnet) DO UPDATE SET {2}'.format(
+                ', '.join(TORRENT_COLUMNS), ', '.join('?' * len(TORRENT_COLUMNS)),
+                ', '.join('{0} = excluded.{0}'.format(c) for c in TORRENT_COLUMNS if c != 'magnet')),
+            [(ep_name,) + torrent.to_row() for torrent in torrents])
+
+    def get_pending_torrents(self) -> dict:
+        # Episodes that have torrent options but haven't been sent to deluge yet
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT t.ep_name, {} FROM episodes e JOIN torrents t USING (ep_name) '
+                                      'WHERE e.added = 0 ORDER BY t.ep_name, t.id'.format(
+                                          ', '.join('t.' + c for c in TORRENT_COLUMNS))).fetchall()
+        pending = {}
+        for row in rows:
+            pending.setdefault(row['ep_name'], []).append(TorrentCandidate.from_row(row))
+        return pending
+
+    def mark_added(self, ep_name: str):
+        with self.transaction() as connection:
+            connection.execute('UPDATE episodes SET added = 1, updated_at = ? WHERE ep_name = ?',
+                               (time.time(), ep_name))
+
+    def get_waiting(self) -> list:
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT episode FROM waiting ORDER BY added_at, ep_name').fetchall()
+        return [Episode.from_json(json.loads(row[0])) for row in rows]
+
+    def get_waiting_entries(self) -> list:
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT {} FROM waiting ORDER BY next_attempt'.format(
+                ', '.join(WAITING_COLUMNS))).fetchall()
+        return [dict(row, episode=Episode.from_json(json.loads(row['episode']))) for row in rows]
+
+    def save_waiting_entries(self, entries: list):
+        # Same as set_waiting, but with the retry bookkeeping of each entry
+        with self.transaction() as connection:
+            stored = {row[0] for row in connection.execute('SELECT ep_name FROM waiting')}
+            connection.executemany('DELETE FROM waiting WHERE ep_name = ?',
+                                   [(ep_name,) for ep_name in stored - {entry['ep_name'] for entry in entries}])
+            connection.executemany(
+                'INSERT INTO waiting ({0}) VALUES ({1}) ON CONFLICT (ep_name) DO UPDATE SET {2}'.format(
+                    ', '.join(WAITING_COLUMNS), ', '.join('?' * len(WAITING_COLUMNS)),
+                    ', '.join('{0} = excluded.{0}'.format(c) for c in WAITING_COLUMNS if c != 'ep_name')),
+                [tuple(json.dumps(entry[c].to_json()) if c == 'episode' else entry[c] for c in WAITING_COLUMNS)
+                 for entry in entries])
+
+    def set_waiting(self, waiting_list: list):
+        # Only touches the rows that changed, entries already waiting keep their original added_at
+        entries = {get_episode_name(episode): episode for episode in waiting_list}
+        with self.transaction() as connection:
+            stored = {row[0] for row in connection.execute('SELECT ep_name FROM waiting')}
+            connection.executemany('DELETE FROM waiting WHERE ep_name = ?',
+                                   [(ep_name,) for ep_name in stored - entries.keys()])
+            now = time.time()
+            connection.executemany('INSERT INTO waiting (ep_name, episode, added_at) VALUES (?, ?, ?) '
+                                   'ON CONFLICT (ep_name) DO UPDATE SET episode = excluded.episode',
+                                   [(ep_name, json.dumps(episode.to_json()), now)
+                                    for ep_name, episode in entries.items()])
+
+
+def import_pickles(store: StateStore, torrents_file_name: str, waiting_file_name: str):
+    # One-time migration of the pickle files used before the state store existed. The pickles are
+    # renamed afterwards so they are never imported twice.
+    if os.path.isfile(torrents_file_name):
+        with open(torrents_file_name, "rb") as pickle_in:
+            torrents = pickle.load(pickle_in)
+        with store.transaction() as connection:
+            for ep_name, ep_torrents in torrents.items():
+                store.upsert_episode(connection, ep_name, [TorrentCandidate.from_row(t) for t in ep_torrents])
+        os.replace(torrents_file_name, torrents_file_name + '.imported')
+        LOGGER.info('Imported {} episodes from {}'.format(len(torrents), torrents_file_name))
+
+    if os.path.isfile(waiting_file_name):
+        with open(waiting_file_name, "rb") as pickle_in:
+            waiting_list = pickle.load(pickle_in)
+        store.set_waiting(store.get_waiting() + [Episode.from_json(episode) for episode in waiting_list])
+        os.replace(waiting_file_name, waiting_file_name + '.imported')
+        LOGGER.info('Imported {} waiting episodes from {}'.format(len(waiting_list), waiting_file_name))
+
+
+def open_state_store(location: str) -> StateStore:
+    store = StateStore(os.path.join(location, STATE_FILE_NAME))
+    import_pickles(store, os.path.join(location, LEGACY_TORRENTS_FILE_NAME),
+                   os.path.join(location, LEGACY_WAITING_FILE_NAME))
+    return store
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    open_state_store(os.path.realpath(os.path.dirname(__file__))).close()
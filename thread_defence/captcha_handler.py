@@ -1,43 +1,99 @@
+import io
 import os
-import pytesseract
 import logging
-from PIL import Image
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import pytesseract
+from PIL import Image, ImageFilter, ImageOps
 
 LOGGER = logging.getLogger(__name__)
-__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+# What the threat defence captchas looked like so far, 5 upper case letters and digits. It isn't a published
+# format: pass the charset and length to CaptchaHandler if they change. A reading that doesn't fit is still
+# submitted when nothing fits, it only ranks lower, and length None checks the charset alone.
+CHARSET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+CAPTCHA_LENGTH = 5
+# Preprocessing variants, each one is read with every tesseract config
+VARIANTS = ['gray', 'threshold_100', 'threshold_140', 'threshold_180', 'median_threshold_140', 'scaled_threshold_140']
+
+
+def make_configs(charset: str = CHARSET) -> list:
+    # psm 7 and 8 limited to the charset, and a plain psm 7 in case the charset is wrong
+    return ['--psm 7 -c tessedit_char_whitelist={}'.format(charset),
+            '--psm 8 -c tessedit_char_whitelist={}'.format(charset),
+            '--psm 7']
+
+
+def preprocess(image: Image.Image, variant: str) -> Image.Image:
+    image = ImageOps.autocontrast(ImageOps.grayscale(image))
+    if variant.startswith('scaled'):
+        image = image.resize((image.width * 3, image.height * 3), Image.LANCZOS)
+    if variant.startswith('median'):
+        # Removes the speckle noise without eating into the strokes
+        image = image.filter(ImageFilter.MedianFilter(3))
+    if 'threshold' in variant:
+        level = int(variant.rsplit('_', 1)[1])
+        image = image.point(lambda value: 255 if value > level else 0)
+    return image
+
+
+def read_captcha(png: bytes, variant: str, config: str) -> tuple:
+    # Runs in the pool: (variant, config, text, mean word confidence)
+    image = preprocess(Image.open(io.BytesIO(png)), variant)
+    data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+    words = [(text.strip(), float(conf)) for text, conf in zip(data['text'], data['conf'])
+             if text.strip() and float(conf) >= 0]
+    if not words:
+        return variant, config, '', 0.0
+    return variant, config, ''.join(text for text, conf in words), sum(conf for text, conf in words) / len(words)
+
+
+def is_valid(text: str, charset: str = CHARSET, length: int = CAPTCHA_LENGTH) -> bool:
+    return (length is None or len(text) == length) and all(char in charset for char in text)
+
+
+def rank_candidates(candidates: list, charset: str = CHARSET, length: int = CAPTCHA_LENGTH) -> list:
+    # Readings that fit the captcha charset come first, then the ones most variants agree on, then confidence
+    votes = Counter(text for variant, config, text, confidence in candidates if text)
+    return sorted((candidate for candidate in candidates if candidate[2]),
+                  key=lambda candidate: (is_valid(candidate[2], charset, length), votes[candidate[2]], candidate[3]),
+                  reverse=True)
+
 
 # Get CAPTCHA image & extract text
 class CaptchaHandler:
 
-    def __init__(self):
-        self.filename = 'solved_captcha.png'
+    def __init__(self, workers: int = None, variants: list = None, configs: list = None, charset: str = CHARSET,
+                 length: int = CAPTCHA_LENGTH):
+        self._workers = workers or os.cpu_count()
+        self._variants = variants or VARIANTS
+        self._configs = configs or make_configs(charset)
+        self._charset = charset
+        self._length = length
+        # Started on the first captcha and reused, tesseract is a subprocess per call anyway
+        self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
 
     def get_captcha(self, driver, element):
         LOGGER.info("Getting captcha")
-        # now that we have the preliminary stuff out of the way time to get that image :D
-        location = element.location
-        size = element.size
-        # saves screenshot of entire page
-        driver.save_screenshot(os.path.join(__location__,self.filename))
-
-        # uses PIL library to open image in memory
-        image = Image.open(os.path.join(__location__,self.filename))
-
-        left = location['x']
-        top = location['y']
-        right = location['x'] + size['width']
-        bottom = location['y'] + size['height']
-
-        image = image.crop((left, top, right, bottom))  # defines crop points
-        image.save(os.path.join(__location__,self.filename), 'png')  # saves new cropped image
-        return self.solve_captcha(os.path.join(__location__,self.filename))
-
-    @staticmethod
-    def solve_captcha(img_path):
-        try:
-            LOGGER.info("Solving captcha")
-            solution = pytesseract.image_to_string(Image.open(img_path))
-            os.remove(img_path)  # Remove the file after solving
-            return solution
-        except FileNotFoundError:
-            return
+        # Only the captcha element is captured, straight into memory
+        return self.solve_captcha(element.screenshot_as_png)
+
+    def solve_captcha(self, png: bytes):
+        LOGGER.info("Solving captcha")
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._workers)
+        jobs = [(variant, config) for variant in self._variants for config in self._configs]
+        candidates = list(self._pool.map(read_captcha, [png] * len(jobs), *zip(*jobs)))
+        ranked = rank_candidates(candidates, self._charset, self._length)
+        if not ranked:
+            LOGGER.info('No text found in captcha')
+            return ''
+        variant, config, text, confidence = ranked[0]
+        LOGGER.info('Best reading {} ({:.0f}% confidence, {} {})'.format(text, confidence, variant, config))
+        return text
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import logging
+import threading
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+COOKIE_VAULT_FILE_NAME = os.path.join(__location__, 'cookie_vault.json')
+# Used for solved sessions that only came back with session cookies
+DEFAULT_TTL = 12 * 60 * 60
+
+
+class CookieVault:
+    # Cookies of solved threat defence sessions per host, kept until the first of them expires
+
+    def __init__(self, file_name: str = COOKIE_VAULT_FILE_NAME, default_ttl: float = DEFAULT_TTL):
+        self._file_name = file_name
+        self._default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.load()
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urllib.parse.urlsplit(url).netloc or url
+
+    def load(self):
+        if self._file_name is None or not os.path.isfile(self._file_name):
+            return
+        try:
+            with open(self._file_name) as vault_in:
+                hosts = json.load(vault_in)
+        except ValueError:
+            LOGGER.info('Ignoring unreadable cookie vault {}'.format(self._file_name))
+            return
+        with self._lock:
+            self._hosts = hosts
+
+    def save(self):
+        if self._file_name is None:
+            return
+        with self._lock:
+            hosts = dict(self._hosts)
+        with open(self._file_name + '.tmp', 'w') as vault_out:
+            json.dump(hosts, vault_out, indent=2)
+        os.replace(self._file_name + '.tmp', self._file_name)
+
+    def get(self, url: str):
+        # name -> value of the cookies stored for the url's host, None when there are none or they expired
+        host = self._host(url)
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                return None
+            if entry['expires'] <= time.time():
+                LOGGER.info('Cookies for {} expired'.format(host))
+                del self._hosts[host]
+                return None
+            return dict(entry['cookies'])
+
+    def put(self, url: str, cookies: list):
+        # cookies as returned by webdriver.get_cookies()
+        now = time.time()
+        expiries = [cookie['expiry'] for cookie in cookies if cookie.get('expiry')]
+        entry = {'cookies': {cookie['name']: cookie['value'] for cookie in cookies if cookie['name'] != ''},
+                 'expires': min(expiries) if expiries else now + self._default_ttl,
+                 'saved_at': now}
+        with self._lock:
+            self._hosts[self._host(url)] = entry
+        LOGGER.info('Stored {} cookies for {} until {}'.format(
+            len(entry['cookies']), self._host(url), time.strftime('%d-%m-%Y %H:%M', time.localtime(entry['expires']))))
+
+    def forget(self, url: str):
+        with self._lock:
+            self._hosts.pop(self._host(url), None)
@@ -1,95 +1,131 @@
-import time
 import logging
 import os
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support.expected_conditions import NoSuchElementException
+from selenium.webdriver.firefox.service import Service
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+
+from http_client import get_http_client
 from thread_defence.captcha_handler import CaptchaHandler
+from thread_defence.cookie_vault import CookieVault
 
 LOGGER = logging.getLogger(__name__)
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
+CAPTCHA_IMAGE = (By.XPATH, "//img[contains(@src, 'captcha')]")
+RETRY_LINK = (By.PARTIAL_LINK_TEXT, 'Click')
+# Current limit is 5 giving pytesseract % of success
+MAX_TRIES = 5
+# Longest wait for the browser detection page to move on
+WAIT_TIMEOUT = 30
+
+
 class ThreatDefenceHandler:
 
-    def __init__(self, cookies=None):
+    def __init__(self, cookies=None, vault: CookieVault = None, http_client=None, wait_timeout: float = WAIT_TIMEOUT):
         if cookies is None:
             cookies = {}
         self.threat_defence = 'threat_defence.php'
         self.options = Options()
-        self.options.headless = True
-        self.driver = webdriver.Firefox(options=self.options, executable_path=os.path.join(__location__,'geckodriver'))
+        self.options.add_argument('-headless')
+        # The browser is only started when a bypass is actually needed, and then reused
+        self._driver = None
         self.tries = 0
         self.captcha_handler = CaptchaHandler()
         self.cookies = cookies
+        self.vault = vault or CookieVault()
+        self._http_client = http_client or get_http_client()
+        self._wait_timeout = wait_timeout
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            LOGGER.info('Starting headless Firefox')
+            self._driver = webdriver.Firefox(options=self.options,
+                                             service=Service(executable_path=os.path.join(__location__, 'geckodriver')))
+        return self._driver
 
     def quit(self):
-        self.driver.quit()
+        self.captcha_handler.close()
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
+
+    def is_blocked(self, url: str, cookies: dict) -> bool:
+        # Plain HTTP probe, the redirect to threat_defence.php shows up without running any javascript
+        response = self._http_client.get(url, cookies=cookies, use_cache=False)
+        return self.threat_defence in response.url or \
+            any(self.threat_defence in r.headers.get('Location', '') for r in response.history)
 
     def get_cookies(self, url):
-        self.driver.get(url)
-        for key, value in self.cookies.items():
-            self.driver.add_cookie({"name": key, "value": value})
+        cookies = self.cookies or self.vault.get(url) or {}
         LOGGER.info("Checking if thread defence is active.")
-        self.driver.get(url)
-        if self.threat_defence in self.driver.current_url:
-            if self.cookies != {}:
-                LOGGER.info("Cookie no longer valid, getting new one")
-            LOGGER.info('Threat defense triggered for {0}'.format(self.driver.current_url))
-            LOGGER.info('Redirected to: {0}'.format(self.driver.current_url))
-            cookies = self.bypass_threat_defense(self.driver.current_url)
-            self.driver.close()
-            return {c["name"]: c["value"] for c in cookies if c["name"]!=''}  # With cookies of solved CAPTCHA session
-        else:
-            self.driver.close()
+        if not self.is_blocked(url, cookies):
             LOGGER.info("Cookies still valid")
-            return self.cookies
+            self.cookies = cookies
+            return cookies
+
+        if cookies != {}:
+            LOGGER.info("Cookie no longer valid, getting new one")
+            self.vault.forget(url)
+        LOGGER.info('Threat defense triggered for {0}'.format(url))
+        solved_cookies = self.bypass_threat_defense(url)
+        self.vault.put(url, solved_cookies)
+        self.vault.save()
+        self.cookies = {c["name"]: c["value"] for c in solved_cookies if c["name"] != ''}
+        return self.cookies  # With cookies of solved CAPTCHA session
+
+    def _wait_for_page(self, driver):
+        # Whatever the browser detection page turned into: passed, a captcha or a retry link
+        if self.threat_defence not in driver.current_url:
+            return 'passed', None
+        for state, locator in (('captcha', CAPTCHA_IMAGE), ('retry', RETRY_LINK)):
+            elements = driver.find_elements(*locator)
+            if elements:
+                return state, elements[0]
+        return False
 
     def bypass_threat_defense(self, url):
-        LOGGER.info('Number of tries: #{0}'.format(self.tries))
+        self.tries = 0
         self.driver.get(url)
-        # While loop to decide whether we are on a browser detection (redirect) page or a captcha page
-        while self.tries <= 5:  # Current limit is 5 giving pytesseract % of success
+        LOGGER.info('Redirected to: {0}'.format(self.driver.current_url))
+        while self.tries <= MAX_TRIES:
+            LOGGER.info('Number of tries: #{0}'.format(self.tries))
             LOGGER.info('Waiting for browser detection')
-            time.sleep(10)
-            try:
-                self.cookies = self.find_solve_submit_captcha()
-                break
-            except NoSuchElementException:
-                LOGGER.info('No CAPTCHA found in page')
             try:
-                self.redirect_retry()
+                state, element = WebDriverWait(self.driver, self._wait_timeout).until(self._wait_for_page)
+            except TimeoutException:
+                LOGGER.info('No CAPTCHA or link in page. EXITING')
                 break
-            except NoSuchElementException:
-                LOGGER.info('No Link in page either. EXITING')
+            if state == 'passed':
                 break
-        # If the solution was wrong and we are prompt with another try call method again
-        if self.threat_defence in self.driver.current_url:
             self.tries += 1
-            LOGGER.info('CAPTCHA solution was wrong. Trying again')
-            self.bypass_threat_defense(self.driver.current_url)
-        if self.cookies:
-            return self.cookies
-        exit('Something went wrong')
+            if state == 'captcha':
+                self.solve_submit_captcha(element)
+            else:
+                LOGGER.info('Retrying to get CAPTCHA page')
+                self.driver.get(element.get_attribute('href'))
+            if self.threat_defence in self.driver.current_url:
+                LOGGER.info('Still on threat defence, trying again')
 
-    # Press retry link if reached a redirect page without captcha
-    def redirect_retry(self):
-        LOGGER.info('Looking for `retry` link in page')
-        link = self.driver.find_element_by_partial_link_text('Click')
-        LOGGER.info('Retrying to get CAPTCHA page')
-        self.tries += 1
-        self.bypass_threat_defense(link.get_attribute('href'))
+        if self.threat_defence in self.driver.current_url:
+            raise RuntimeError('Could not get past threat defence after {} tries'.format(self.tries))
+        return self.driver.get_cookies()
 
-    def find_solve_submit_captcha(self):
-        LOGGER.info('Looking for CAPTCHA image in page')
-        # Find
-        captcha = self.driver.find_element_by_xpath("//img[contains(@src, 'captcha')]")
+    def solve_submit_captcha(self, captcha):
         LOGGER.info('Found CAPTCHA image')
         # Solve
         solved_captcha = self.captcha_handler.get_captcha(element=captcha, driver=self.driver)
         LOGGER.info('CAPTCHA solved: {0}'.format(solved_captcha))
-        input_field = self.driver.find_element_by_id('solve_string')
+        input_field = self.driver.find_element(By.ID, 'solve_string')
         input_field.send_keys(solved_captcha)
         LOGGER.info('Submitting solution')
-        # Submit
-        self.driver.find_element_by_id('button_submit').click()
-        return self.driver.get_cookies()
+        # Submit, then wait for the answer to replace the page
+        self.driver.find_element(By.ID, 'button_submit').click()
+        try:
+            WebDriverWait(self.driver, self._wait_timeout).until(expected_conditions.staleness_of(captcha))
+        except TimeoutException:
+            LOGGER.info('Page did not change after submitting')
@@ -1,212 +1,369 @@
 #!/usr/bin/python3
 import os
-import pprint
 
-import arrow
-import requests
-import bs4
-import re
-import json
+import bisect
 import pickle
-import logging.config
-
-import rarbgapi
-
-import pdb
-
-logging.config.dictConfig(config={
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'default': {
-            'format': '%(asctime)s: %(module)22s->%(funcName)-26s - [%(levelname)5s] - %(message)s',
-            'datefmt': '[%d-%m-%Y | %H:%M:%S]'
-        }
-    },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'default',
-            'level': 'DEBUG',
-        },
-        'file': {
-            'class': 'logging.handlers.TimedRotatingFileHandler',
-            'filename': '/var/log/auto_torrent/auto_torrent.log',
-            #'filename': 'auto_torrent.log',
-            # 'mode': 'w',
-            'formatter': 'default',
-            'when': 'midnight',
-            'backupCount': 10,
-                        'level': 'DEBUG'
-        },
-    },
-    'root': {
-        'handlers': ['file', 'console'],
-        'level': 'INFO',
-    },
-})
+import time
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import HttpClient, get_http_client
+from indexers import INDEXERS_FILE_NAME, IndexerPool, RarbgIndexer, load_indexers
+from metrics import METRICS, profiled
+from records import Episode, Quality, RipType, TorrentCandidate
+from query_planner import SeriesQuery, plan_episode_queries, plan_series_queries
+from retry_scheduler import schedule_releases
+from search_cache import SearchCache
+from torrent_title_parser import TorrentTitleParser, get_episode_name, get_series_title_re
+from state_store import open_state_store
 
 __location__ = os.path.realpath(os.path.join(
     os.getcwd(), os.path.dirname(__file__)))
-pickle_file_name = os.path.join(__location__, 'torrents.pickle')
-waiting_list_pickle_file_name = os.path.join(
-    __location__, 'waiting_torrents.pickle')
+search_cache_file_name = os.path.join(__location__, 'search_cache.pickle')
+pog_calendar_file_name = os.path.join(__location__, 'pog_calendar.pickle')
+
+# Episodes airing in the next LOOKAHEAD_DAYS get their season searched ahead of time, at most
+# PREFETCH_BUDGET indexer searches per run
+LOOKAHEAD_DAYS = 2
+PREFETCH_BUDGET = 10
 
 LOGGER = logging.getLogger(__name__)
 
 
 class PogCalendar:
 
+    # Bumped whenever the pickled calendar changes shape, older pickles are parsed again
+    FORMAT = 2
+
+    # Compiled on the first parse, lxml evaluates it in C without building a bs4 tree
+    _DAY_XPATH = None
+
     def __init__(self):
         self._month_releases = []
+        # day -> episodes, plus the sorted days for range queries
+        self._releases_by_day = {}
+        self._days = []
 
+    @METRICS.timed('calendar_parse')
     def parse(self, html_data):
-        soup_obj = bs4.BeautifulSoup(html_data.text, features="lxml")
-        for div_day in soup_obj.find_all('div', {"class": {'today', 'day'}}):
-            date = arrow.get(div_day.select('a')[0].get(
-                'title'), "dddd Do MMMM YYYY").date()
+        # Only a changed calendar is parsed, a cached one is unpickled without lxml or arrow
+        import arrow
+        import lxml.html
+        from lxml import etree
+        if PogCalendar._DAY_XPATH is None:
+            PogCalendar._DAY_XPATH = etree.XPath(
+                '//div[contains(concat(" ", normalize-space(@class), " "), " day ") or '
+                'contains(concat(" ", normalize-space(@class), " "), " today ")]')
+        document = lxml.html.fromstring(html_data.text)
+        for div_day in self._DAY_XPATH(document):
+            date = arrow.get(div_day.find('.//a').get('title'), "dddd Do MMMM YYYY").date()
             day_releases = {'day': date, 'episodes': []}
-            for div_ep in div_day.select('div'):
-                last_ep = True if 'lastep' in div_ep.select(
-                    'span')[0].get('class') else False
-                first_ep = True if 'firstep' in div_ep.select(
-                    'span')[0].get('class') else False
-                series_ref = div_ep.select(
-                    'input')[0].get('value').split('-')[0]
+            for div_ep in div_day.iterfind('.//div'):
+                span_class = (div_ep.find('.//span').get('class') or '').split()
+                series_ref = div_ep.find('.//input').get('value').split('-')[0]
                 series_name, ep_num, ep_title, series_provider = [line.strip() for line in
-                                                                  div_ep.text.strip().split("\n")]
+                                                                  div_ep.text_content().strip().split("\n")]
                 series_provider = series_provider.split('-')[0].strip()
-                episode = {'name': series_name, 'number': ep_num,
-                           'provider': series_provider, 'series_ref': series_ref,
-                           'last_ep': last_ep, 'first_ep': first_ep}
+                episode = Episode.create(series_name, ep_num, series_provider, series_ref,
+                                         first_ep='firstep' in span_class, last_ep='lastep' in span_class)
                 day_releases['episodes'].append(episode)
             self._month_releases.append(day_releases)
+            self._releases_by_day.setdefault(date, []).extend(day_releases['episodes'])
+        self._days = sorted(self._releases_by_day)
+        METRICS.inc('calendar_episodes', sum(len(episodes) for episodes in self._releases_by_day.values()))
+
+    def get_releases(self, day) -> list:
+        return list(self._releases_by_day.get(day, []))
+
+    def get_releases_between(self, start, end) -> list:
+        # Inclusive on both ends, returned in the same {'day', 'episodes'} shape as get_month_releases
+        first = bisect.bisect_left(self._days, start)
+        last = bisect.bisect_right(self._days, end)
+        return [{'day': day, 'episodes': list(self._releases_by_day[day])} for day in self._days[first:last]]
 
     def get_today_releases(self) -> list:
-        today_rel = next(
-            (x for x in self._month_releases if x['day'] == arrow.now().date()), None)
-        return today_rel['episodes']
+        return self.get_releases(datetime.date.today())
 
     def get_month_releases(self):
         return self._month_releases.copy()
 
 
-def get_pog_calendar() -> PogCalendar:
-    with open(os.path.join(__location__, 'pog_cookie.json')) as cookie:
-        pog_cookie = json.load(cookie)
+def get_pog_calendar(http_client: HttpClient = None) -> PogCalendar:
+    http_client = http_client or get_http_client()
+    pog_cookie = http_client.load_cookies(os.path.join(__location__, 'pog_cookie.json'))
 
-    get = requests.get('https://www.pogdesign.co.uk/cat/', cookies=pog_cookie)
-    LOGGER.info('PogDesign Get response: {}'.format(get.status_code))
+    with METRICS.timer('calendar_fetch'):
+        get = http_client.get('https://www.pogdesign.co.uk/cat/', cookies=pog_cookie)
+    LOGGER.info('PogDesign Get response: {}{}'.format(get.status_code, ' (not modified)' if get.from_cache else ''))
     get.raise_for_status()
 
+    # The parsed calendar is kept along with the validator of the page it came from, so an
+    # unchanged month is neither downloaded nor parsed again
+    validator = get.headers.get('ETag') or get.headers.get('Last-Modified')
+    if get.from_cache and os.path.isfile(pog_calendar_file_name):
+        with open(pog_calendar_file_name, "rb") as pickle_in:
+            cached = pickle.load(pickle_in)
+        # (format, validator, calendar), pickles from before the format was recorded are (validator, calendar)
+        if len(cached) == 3 and cached[0] == PogCalendar.FORMAT and cached[1] == validator:
+            METRICS.inc('calendar_cache_hits')
+            return cached[2]
+
     calendar = PogCalendar()
     calendar.parse(get)
 
+    if validator is not None:
+        with open(pog_calendar_file_name, "wb") as pickle_out:
+            pickle.dump((PogCalendar.FORMAT, validator, calendar), pickle_out)
+
     return calendar
 
 
 class Rarbg:
-
-    def __init__(self, retries: int = 3):
-        self._client = rarbgapi.RarbgAPI(retries=retries)
+    # Finds the torrents of episodes on every configured indexer, named after torrentapi, the first one
+
+    def __init__(self, retries: int = 3, workers: int = 1, requests_per_second: float = None,
+                 backoff: float = 1.0, max_backoff: float = 16.0, cache: SearchCache = None, indexers: list = None):
+        # torrentapi alone unless other indexers are configured
+        if indexers is None:
+            indexers = [RarbgIndexer(retries=retries, requests_per_second=requests_per_second, backoff=backoff,
+                                     max_backoff=max_backoff)]
+        # Every worker may have a hedged request in flight on each indexer
+        self._indexers = IndexerPool(indexers, max_workers=2 * workers)
         self._searchRetries = retries
-
-    def _search(self, searchString: str) -> list:
-        myCategories = [rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES_UHD,
-                        rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES_HD,
-                        rarbgapi.RarbgAPI.CATEGORY_TV_EPISODES]
-
-        searchResults = []
-        searchRetries = 0
-
-        while (len(searchResults) == 0 and searchRetries < self._searchRetries):
-            searchResults = self._client.search(
-                search_string=searchString, categories=myCategories, extended_response=True)
-            searchRetries += 1
+        self._workers = workers
+        self._cache = cache
+        self._title_parser = TorrentTitleParser()
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def close(self):
+        self._indexers.close()
+
+    def _cache_key(self, searchString: str) -> tuple:
+        # Merged results are only valid for the indexers they were merged from, a search cached before
+        # an indexer was added or removed isn't served. Results of torrentapi alone from before the
+        # indexers (keyed by its categories) never match either.
+        return 'indexers', searchString, self._indexers.names
+
+    def _search(self, searchString: str, retries: int = None, ttl: float = None) -> list:
+        cache_key = self._cache_key(searchString)
+        if self._cache is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                METRICS.inc('search_cache_hits')
+                return cached
+            METRICS.inc('search_cache_misses')
+
+        with METRICS.timer('indexer_search'):
+            searchResults, complete = self._indexers.search(searchString, retries=retries or self._searchRetries)
+
+        if self._cache is not None and complete:
+            # Not when an indexer failed, it gets asked again next time
+            self._cache.put(cache_key, searchResults, ttl=ttl if searchResults else None)
 
         return searchResults
 
+    def _find_series_torrents(self, query: SeriesQuery) -> dict:
+        # ep_name -> parsed torrents, None when the episode is covered by a season pack
+        return {ep_name: None if validSearchResults is None else self.parse_search_results(validSearchResults)
+                for ep_name, validSearchResults in self.search_series(query).items()}
+
+    def search_series(self, query: SeriesQuery) -> dict:
+        # ep_name -> matching search results, or None when the episode is covered by a season pack.
+        # Every episode of the query shares one season search, episode searches are only made for the
+        # episodes it has no results for
+        searchResults = self._search(query.search_string)
+
+        torrent_name_re = get_series_title_re(query.series_name, query.season_number, season_pack=True)
+        seasonPacks = [torrent for torrent in searchResults if torrent_name_re.search(torrent.title)]
+
+        episodeResults = {}
+        for ep_name, episode in query.episodes.items():
+            if len(seasonPacks) > 0 and not episode.last_ep:
+                # Downloading complete season, along with the first episode
+                episodeResults[ep_name] = seasonPacks if episode.first_ep else None
+                continue
+
+            torrent_name_re = get_series_title_re(episode.name, episode.number)
+            validSearchResults = [
+                torrent for torrent in searchResults if torrent_name_re.search(torrent.title)]
+            if len(validSearchResults) == 0:
+                mySearchString = episode.name + " " + episode.number
+                validSearchResults = [
+                    torrent for torrent in self._search(mySearchString) if torrent_name_re.search(torrent.title)]
+            else:
+                METRICS.inc('episode_searches_saved')
+            episodeResults[ep_name] = validSearchResults
+
+        return episodeResults
+
+    def warm_up(self, query: SeriesQuery):
+        # Resolves the series name and title regexes of upcoming episodes, so air day starts warm
+        get_series_title_re(query.series_name, query.season_number, season_pack=True)
+        for ep_name, episode in query.episodes.items():
+            get_series_title_re(episode.name, episode.number)
+
+    def prefetch(self, query: SeriesQuery, starts_in: float, ttl: float) -> bool:
+        # Caches the season search of an upcoming query whose air day starts in starts_in seconds, True if the
+        # indexer was searched. Only once per season, and only once the result stays cached into the air day:
+        # searched earlier it would expire first and be searched again. A single attempt: nothing may be out yet
+        # and that's not worth retrying for. Never cached for longer than any other search, so releases posted
+        # after the prefetch aren't hidden on air day.
+        if self._cache is None or starts_in >= self._cache.ttl:
+            return False
+        cache_key = self._cache_key(query.search_string)
+        # Remembered until the end of the air day, an empty or failed prefetch isn't searched again either
+        prefetched_key = ('prefetched',) + cache_key
+        if prefetched_key in self._cache or cache_key in self._cache:
+            return False
+        self._search(query.search_string, retries=1, ttl=min(ttl, self._cache.ttl))
+        self._cache.put(prefetched_key, True, ttl=ttl)
+        return True
+
+    @METRICS.timed('title_parse')
+    def parse_search_results(self, validSearchResults: list) -> list:
+        ep_torrents = []
+        for result in validSearchResults:
+            parsed_title = self._title_parser.parse(result.title)
+
+            ep_torrents.append(TorrentCandidate(
+                result.title, result.magnet, result.link, rip_type=RipType.from_label(parsed_title.rip_type),
+                quality=Quality.from_label(parsed_title.quality), size=result.size, seeders=result.seeders))
+            LOGGER.info('Added: {:s} ({:s})'.format(result.title, result.indexer))
+
+        METRICS.inc('torrent_candidates', len(ep_torrents))
+        return ep_torrents
+
+    @staticmethod
+    def is_wanted(episode: Episode) -> bool:
+        # im paying for netflix and disney+, no need to download :)
+        return episode.provider != 'Netflix' and episode.provider != 'Disney+'
+
     def get_today_torrent_releases(self, releases: list, saved_torrents: dict) -> [dict, list]:
         waiting_list = []
+        pending = []
 
         for episode in releases:
-            # im paying for netflix and disney+, no need to download :)
-            if episode['provider'] != 'Netflix' and episode['provider'] != 'Disney+':
-
-                ep_name = '_'.join(
-                    ['_'.join(re.split('\s|: ', episode['name'])), episode['number']])
-                ep_torrents = saved_torrents.get(ep_name, None)
-                if ep_torrents is None:
-                    LOGGER.info("ep_torrents empty")
-                    ep_torrents = []
-                else:
-                    # Already in the torrent list
-                    continue
-
-                season_number = re.compile(
-                    r'(s\d+)e\d+', re.IGNORECASE).search(episode['number']).group(1)
-                mySearchString = episode["name"] + " " + season_number
-                searchResults = self._search(mySearchString)
-
-                torrent_name_re = re.compile(r'^{:s}.*{:s}\W+.*$'.format('.'.join(re.split('\s|: ', episode['name'])),
-                                                                         season_number), re.IGNORECASE)
-                validSearchResults = [
-                    torrent for torrent in searchResults if torrent_name_re.search(torrent.title)]
+            if self.is_wanted(episode):
 
-                if (len(validSearchResults) == 0 or episode['last_ep']):
-                    mySearchString = episode["name"] + " " + episode["number"]
-                    searchResults = self._search(mySearchString)
-
-                    torrent_name_re = re.compile(r'^{:s}.*{:s}.*$'.format('.'.join(
-                        re.split('\s|: ', episode['name'])), episode['number']), re.IGNORECASE)
-                    validSearchResults = [
-                        torrent for torrent in searchResults if torrent_name_re.search(torrent.title)]
-
-                elif (not episode['first_ep']):
-                    # Downloading complete season
+                ep_name = get_episode_name(episode)
+                if ep_name in saved_torrents:
+                    # Already in the torrent list
                     continue
 
-                if (len(validSearchResults) > 0):
-                    for torrent in validSearchResults:
-                        title = torrent.filename
+                LOGGER.info("ep_torrents empty")
+                pending.append((ep_name, episode))
+
+        # One query per series and season, repeated episodes (e.g. also on the waiting list) are only
+        # searched once
+        queries = plan_series_queries(pending)
+        METRICS.inc('series_queries', len(queries))
+        if self._workers > 1 and len(queries) > 1:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                results = list(executor.map(self._find_series_torrents, queries))
+        else:
+            results = [self._find_series_torrents(query) for query in queries]
+        found = {}
+        for query_results in results:
+            found.update(query_results)
+
+        # Results are merged in release order, so the output is the same as a serial run
+        for ep_name, episode in pending:
+            ep_torrents = found[ep_name]
+            if ep_torrents is None or ep_name in saved_torrents:
+                continue
+
+            if (len(ep_torrents) > 0):
+                saved_torrents[ep_name] = ep_torrents
+            else:
+                waiting_list.append(episode)
+                LOGGER.info('Added to waiting list: {:s} {:s}'.format(
+                    episode.name, episode.number))
 
-                        torrent_quality_re = re.compile(
-                            r'(1080p|720p)', re.IGNORECASE)
-                        quality = torrent_quality_re.search(title).group() if torrent_quality_re.search(
-                            title) is not None else 'Standard'
+        LOGGER.info('Done parsing search results')
+        return saved_torrents, waiting_list
 
-                        torrent_rip_type_re = re.compile(
-                            r'\.(HDTV|WEB[\w|-]*)\.', re.IGNORECASE)
-                        rip_type = torrent_rip_type_re.search(title).group(1) if torrent_rip_type_re.search(
-                            title) is not None else 'Undefined'
 
-                        magnet = torrent.download
-                        link = torrent.info_page  # ?
-                        size = torrent.size/1024/1024
-                        seeds = torrent.seeders
+def search_releases(rarbg_client: Rarbg, store, today_releases: list) -> list:
+    # Today's releases join the waiting episodes in the retry scheduler, only the episodes that are due
+    # get searched. Returns the episodes still waiting.
+    scheduler, due_releases = schedule_releases(store, today_releases)
+    METRICS.inc('episodes_searched', len(due_releases))
+    LOGGER.info('Searching {} of {} episodes'.format(len(due_releases), len(scheduler)))
+    [updated_torrents, waiting_list] = rarbg_client.get_today_torrent_releases(due_releases, store.torrents)
+    # A serial search either covers every episode or raises before anything is recorded
+    waiting = {get_episode_name(episode) for episode in waiting_list}
+    finished = [episode for episode in due_releases if get_episode_name(episode) not in waiting]
+
+    waiting_list = scheduler.record_results(due_releases, finished)
+    LOGGER.info('Saving waiting list')
+    scheduler.save()
+    return waiting_list
+
+
+def get_upcoming_releases(pog_calendar: PogCalendar, days: int = LOOKAHEAD_DAYS) -> list:
+    # (air day, episode) for everything airing in the next days, today left out
+    today = datetime.date.today()
+    return [(day_releases['day'], episode)
+            for day_releases in pog_calendar.get_releases_between(today + datetime.timedelta(days=1),
+                                                                  today + datetime.timedelta(days=days))
+            for episode in day_releases['episodes']]
+
+
+def get_upcoming_queries(rarbg_client: Rarbg, pog_calendar: PogCalendar, days: int = LOOKAHEAD_DAYS) -> list:
+    # (air day, query) for the wanted upcoming episodes, the air day of a query is its earliest episode's
+    upcoming = [(day, episode) for day, episode in get_upcoming_releases(pog_calendar, days)
+                if rarbg_client.is_wanted(episode)]
+    air_days = {}
+    for day, episode in upcoming:
+        air_days.setdefault(get_episode_name(episode), day)
+    return [(min(air_days[ep_name] for ep_name in query.episodes), query)
+            for query in plan_episode_queries([episode for day, episode in upcoming])]
+
+
+def warm_up_releases(rarbg_client: Rarbg, pog_calendar: PogCalendar, days: int = LOOKAHEAD_DAYS):
+    # Only worth it in a process that is still running on air day, i.e. the daemon
+    for air_day, query in get_upcoming_queries(rarbg_client, pog_calendar, days):
+        rarbg_client.warm_up(query)
+
+
+def prefetch_releases(rarbg_client: Rarbg, pog_calendar: PogCalendar, days: int = LOOKAHEAD_DAYS,
+                      budget: int = PREFETCH_BUDGET) -> int:
+    # Season searches of upcoming episodes are cached like any other search, but never past the end of
+    # their air day. A season is searched once, by the first run within the cache TTL of its air day, so the
+    # series query on air day only searches for the episodes missing from it. Seasons skipped don't count
+    # against the budget.
+    searched = 0
+    queries = get_upcoming_queries(rarbg_client, pog_calendar, days)
+    now = time.time()
+    for air_day, query in queries:
+        if searched >= budget:
+            break
+        starts = time.mktime(air_day.timetuple())
+        expires = time.mktime((air_day + datetime.timedelta(days=1)).timetuple())
+        if rarbg_client.prefetch(query, starts_in=starts - now, ttl=expires - now):
+            searched += 1
+
+    METRICS.inc('prefetch_searches', searched)
+    LOGGER.info('Prefetched {} of {} upcoming seasons'.format(searched, len(queries)))
+    return searched
 
-                        ep_torrents.append(
-                            {'title': title, 'link': link, 'rip_type': rip_type, 'quality': quality, 'size': size,
-                             'magnet': magnet, 'seeders': seeds})
-                        LOGGER.info('Added: {:s}'.format(title))
 
-                    saved_torrents[ep_name] = ep_torrents
-                else:
-                    waiting_list.append(episode)
-                    LOGGER.info('Added to waiting list: {:s} {:s}'.format(
-                        episode['name'], episode['number']))
+def main():
+    LOGGER.info('Starting Torrent List Generator')
+    with profiled('generator'):
+        run()
+    METRICS.write('generator')
 
-        LOGGER.info('Done parsing search results')
-        return saved_torrents, waiting_list
+    LOGGER.info('Exiting!')
+    LOGGER.info('-' * 50)
 
 
-def main():
-    LOGGER.info('Starting Torrent List Generator')
-    torrents = {}
-    if os.path.isfile(pickle_file_name):
-        with open(pickle_file_name, "rb") as pickle_in:
-            torrents = pickle.load(pickle_in)
-            # pprint.pprint(torrents)
+def run():
+    store = open_state_store(__location__)
 
     pog_calendar = get_pog_calendar()
     today_releases = pog_calendar.get_today_releases()
@@ -214,26 +371,23 @@ def main():
     # For testing:
     #today_releases = [{'name': 'Raised by Wolves', 'number': 's01e01', 'provider': 'HBO'}]
 
-    if os.path.isfile(waiting_list_pickle_file_name):
-        with open(waiting_list_pickle_file_name, "rb") as pickle_in:
-            today_releases.extend(pickle.load(pickle_in))
+    search_cache = SearchCache(search_cache_file_name)
+    rarbgClient = Rarbg(retries=10, workers=4, cache=search_cache,
+                        indexers=load_indexers(os.path.join(__location__, INDEXERS_FILE_NAME)))
+    # Every episode found is upserted into the state store as soon as it is merged
+    search_releases(rarbgClient, store, today_releases)
+    prefetch_releases(rarbgClient, pog_calendar)
 
-    rarbgClient = Rarbg(retries=10)
-    [updated_torrents, waiting_list] = rarbgClient.get_today_torrent_releases(
-        today_releases, torrents)
+    rarbgClient.close()
+    search_cache.save()
+    LOGGER.info('Search cache: {hits} hits, {misses} misses, {entries} entries'.format(**search_cache.stats()))
 
-    with open(pickle_file_name, "wb") as pickle_out:
-        LOGGER.info('Saving updated torrent data')
-        pickle.dump(updated_torrents, pickle_out)
-
-    with open(waiting_list_pickle_file_name, "wb") as pickle_out:
-        LOGGER.info('Saving waiting list')
-        pickle.dump(waiting_list, pickle_out)
-
-    LOGGER.info('Exiting!')
-    LOGGER.info('-' * 50)
+    store.close()
+    get_http_client().log_stats()
 
 
 # ---- ----
 if __name__ == '__main__':
+    from log_config import configure_logging
+    configure_logging()
     main()
@@ -0,0 +1,82 @@
+import math
+
+from records import Quality, RipType, TorrentCandidate
+from torrent_title_parser import TorrentTitleParser
+
+DEFAULT_WEIGHTS = {
+    # Large enough that any WEB release beats any HDTV one, like the old get_best_torrent_option
+    'rip_type': 10.0,
+    'quality': 0.0,
+    'size': 0.0,
+    'seeders': 1.0,
+    'group': 0.0,
+}
+RIP_TYPE_SCORES = {RipType.WEB: 1.0, RipType.HDTV: 0.5}
+QUALITY_SCORES = {Quality.HD_1080P: 1.0, Quality.HD_720P: 0.6, Quality.STANDARD: 0.0}
+# Seeder counts are compressed on a log scale that saturates here
+SEEDERS_CAP = 10000
+
+
+class TorrentRanker:
+
+    def __init__(self, weights: dict = None, rip_type_scores: dict = None, quality_scores: dict = None,
+                 size_window: tuple = (None, None), preferred_groups=(), title_parser: TorrentTitleParser = None):
+        self._weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self._rip_type_scores = rip_type_scores or RIP_TYPE_SCORES
+        self._quality_scores = quality_scores or QUALITY_SCORES
+        # Bytes
+        self._min_size, self._max_size = size_window
+        self._preferred_groups = {group.casefold() for group in preferred_groups}
+        self._title_parser = title_parser or TorrentTitleParser()
+        self._log_seeders_cap = math.log1p(SEEDERS_CAP)
+        # Only the criteria that can change the score are evaluated
+        criteria = {'rip_type': self._score_rip_type, 'quality': self._score_quality, 'size': self._score_size,
+                    'seeders': self._score_seeders, 'group': self._score_group}
+        self._criteria = [(self._weights[name], criterion) for name, criterion in criteria.items()
+                          if self._weights.get(name)]
+
+    def _score_rip_type(self, torrent: TorrentCandidate) -> float:
+        return self._rip_type_scores.get(torrent.rip_type, 0.0)
+
+    def _score_quality(self, torrent: TorrentCandidate) -> float:
+        return self._quality_scores.get(torrent.quality, 0.0)
+
+    def _score_size(self, torrent: TorrentCandidate) -> float:
+        size = torrent.size
+        if self._min_size is not None and size < self._min_size:
+            return 0.0
+        if self._max_size is not None and size > self._max_size:
+            return 0.0
+        return 1.0
+
+    def _score_seeders(self, torrent: TorrentCandidate) -> float:
+        return min(1.0, math.log1p(torrent.seeders) / self._log_seeders_cap)
+
+    def _score_group(self, torrent: TorrentCandidate) -> float:
+        group = self._title_parser.group(torrent.title)
+        return 1.0 if group is not None and group.casefold() in self._preferred_groups else 0.0
+
+    def score(self, torrent: TorrentCandidate) -> float:
+        return sum(weight * criterion(torrent) for weight, criterion in self._criteria)
+
+    def _key(self, torrent: TorrentCandidate) -> tuple:
+        # Raw seeders break ties, e.g. between releases above SEEDERS_CAP
+        return self.score(torrent), torrent.seeders
+
+    def best(self, torrent_options: list):
+        # Linear top-1 selection, nothing is sorted
+        if not torrent_options:
+            return None
+        return max(torrent_options, key=self._key)
+
+    def rank(self, torrent_options: list) -> list:
+        return sorted(torrent_options, key=self._key, reverse=True)
+
+    def rank_all(self, torrents: dict) -> dict:
+        # Best option per episode for a whole ep_name -> options mapping, episodes without options are left out
+        best_options = {}
+        for ep_name, torrent_options in torrents.items():
+            best = self.best(torrent_options)
+            if best is not None:
+                best_options[ep_name] = best
+        return best_options